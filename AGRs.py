@@ -7,41 +7,181 @@ import torch.nn as nn
 import argparse, os, sys, csv, shutil, time, random, operator, pickle, ast, math, copy
 import numpy as np
 
-    
-def tr_mean(all_updates, n_attackers):
-    sorted_updates = torch.sort(all_updates, 0)[0]
-    out = torch.mean(sorted_updates[n_attackers:-n_attackers], 0) if n_attackers else torch.mean(sorted_updates,0)
+
+def accum_dtype(all_updates):
+    # updates may be stored in half precision, aggregates are always at least float32
+    return torch.promote_types(all_updates.dtype, torch.float32)
+
+def update_mean(all_updates, weights=None, chunk_size=2**18):
+    """Mean of the rows of all_updates; row i counts weights[i] times if weights are given."""
+    if weights is None:
+        return torch.mean(all_updates, 0, dtype=accum_dtype(all_updates))
+    out = torch.empty(all_updates.shape[1:], dtype=accum_dtype(all_updates), device=all_updates.device)
+    w = weights.to(out.dtype)
+    for start in range(0, all_updates.shape[1], chunk_size):
+        torch.mv(all_updates[:, start:start + chunk_size].t().to(out.dtype), w, out=out[start:start + chunk_size])
+    return out.div_(w.sum())
+
+def update_std(all_updates, chunk_size=2**18):
+    """Coordinate-wise std of all_updates, computed in float32 chunk by chunk."""
+    out = torch.empty(all_updates.shape[1:], dtype=accum_dtype(all_updates), device=all_updates.device)
+    for start in range(0, all_updates.shape[1], chunk_size):
+        out[start:start + chunk_size] = torch.std(all_updates[:, start:start + chunk_size].to(out.dtype), 0)
+    return out
+
+def tr_mean(all_updates, n_attackers, chunk_size=2**18, weights=None):
+    """Coordinate-wise mean of all_updates without the n_attackers largest and smallest values.
+
+    The trimmed sum is taken as total - topk(largest) - topk(smallest) in float64,
+    chunk by chunk along the parameters, instead of sorting the whole matrix.
+    With weights, row i stands for weights[i] identical rows.
+    """
+    if not n_attackers:
+        return update_mean(all_updates, weights)
+    if weights is not None:
+        return weighted_tr_mean(all_updates, weights, n_attackers, chunk_size)
+
+    n_kept = len(all_updates) - 2 * n_attackers
+    out = torch.empty(all_updates.shape[1:], dtype=accum_dtype(all_updates), device=all_updates.device)
+    if n_kept <= 0:
+        return out.fill_(float('nan'))
+
+    for start in range(0, all_updates.shape[1], chunk_size):
+        chunk = all_updates[:, start:start + chunk_size]
+        trimmed = chunk.sum(0, dtype=torch.float64)
+        trimmed -= chunk.topk(n_attackers, 0)[0].sum(0, dtype=torch.float64)
+        trimmed -= chunk.topk(n_attackers, 0, largest=False)[0].sum(0, dtype=torch.float64)
+        out[start:start + chunk_size] = trimmed / n_kept
+    return out
+
+def weighted_tr_mean(all_updates, weights, n_attackers, chunk_size=2**18):
+    """tr_mean of the rows of all_updates repeated weights[i] times, without repeating them.
+
+    With a single repeated row (the malicious update of a round) the other
+    rows are trimmed with topk as in tr_mean and the copies of the repeated
+    row are placed by counting the values below it. Otherwise every column is
+    sorted once; each value is kept as often as its copies fall into the kept
+    range [n_attackers, total - n_attackers) of the sorted multiset.
+    """
+    total = int(weights.sum())
+    n_kept = total - 2 * n_attackers
+    out = torch.empty(all_updates.shape[1:], dtype=accum_dtype(all_updates), device=all_updates.device)
+    if n_kept <= 0:
+        return out.fill_(float('nan'))
+
+    weights = weights.to(all_updates.device)
+    repeated = (weights != 1).nonzero().flatten()
+    if len(repeated) == 1 and len(all_updates) - 1 >= n_attackers:
+        return _tr_mean_one_repeated(all_updates, int(repeated), int(weights[repeated]), n_attackers, out, chunk_size)
+
+    for start in range(0, all_updates.shape[1], chunk_size):
+        values, order = all_updates[:, start:start + chunk_size].sort(0)
+        w = weights[order]
+        end = w.cumsum(0)
+        kept = (end.clamp(max=total - n_attackers) - (end - w).clamp(min=n_attackers)).clamp_(min=0)
+        out[start:start + chunk_size] = (values.double() * kept).sum(0) / n_kept
+    return out
+
+def _tr_mean_one_repeated(all_updates, row, weight, n_attackers, out, chunk_size):
+    # m unit rows plus `weight` copies of all_updates[row], a values trimmed per side
+    a, m = n_attackers, len(all_updates) - 1
+    total = m + weight
+    others = torch.ones(len(all_updates), dtype=torch.bool, device=all_updates.device)
+    others[row] = False
+    for start in range(0, all_updates.shape[1], chunk_size):
+        chunk = all_updates[others, start:start + chunk_size]
+        value = all_updates[row, start:start + chunk_size]
+        # the sorted column is sorted[:k], the copies, sorted[k:]; the unit rows
+        # kept are then sorted[lo:hi], which only moves within the a trimmed per side
+        k = (chunk < value).sum(0)
+        lo = k.clamp(a - weight, a)
+        hi = k.clamp(m - a, m - a + weight)
+        smallest = torch.zeros((a + 1, chunk.shape[1]), dtype=torch.float64, device=chunk.device)
+        largest = torch.zeros_like(smallest)
+        torch.cumsum(chunk.topk(a, 0, largest=False)[0], 0, dtype=torch.float64, out=smallest[1:])
+        torch.cumsum(chunk.topk(a, 0)[0], 0, dtype=torch.float64, out=largest[1:])
+        trimmed = chunk.sum(0, dtype=torch.float64)
+        trimmed -= smallest.gather(0, lo[None])[0] + largest.gather(0, (m - hi)[None])[0]
+        n_copies = ((k + weight).clamp(max=total - a) - k.clamp(min=a)).clamp_(min=0)
+        trimmed += n_copies * value.double()
+        out[start:start + chunk_size] = trimmed / (total - 2 * a)
     return out
 
-def multi_krum(all_updates, n_attackers, multi_k=False):
+def pairwise_distances(all_updates, chunk_size=2**18):
+    """Squared euclidean distances between all rows of all_updates.
+
+    Built from the Gram matrix of the mean-centred updates, accumulated in
+    float64 over column chunks to keep the precision of the direct norms.
+    """
+    n = len(all_updates)
+    gram = torch.zeros((n, n), dtype=torch.float64, device=all_updates.device)
+    for start in range(0, all_updates.shape[1], chunk_size):
+        chunk = all_updates[:, start:start + chunk_size].double()
+        chunk = chunk - chunk.mean(0)
+        gram += chunk @ chunk.t()
+    sq_norms = torch.diagonal(gram)
+    distances = (sq_norms[:, None] + sq_norms[None, :] - 2 * gram).clamp_(min=0)
+    distances.fill_diagonal_(0)
+    return distances
+
+def krum_select(distances, n_attackers, multi_k=False, weights=None):
+    """Runs the (multi-)krum selection on a precomputed distance matrix.
+
+    With weights, row i stands for weights[i] identical updates and can be
+    selected up to weights[i] times.
+    """
+    if weights is not None:
+        return weighted_krum_select(distances, weights, n_attackers, multi_k)
+    n = len(distances)
+    remaining = torch.ones(n, dtype=torch.bool, device=distances.device)
+    candidate_indices = []
+
+    while n - len(candidate_indices) > 2 * n_attackers + 2:
+        n_closest = n - len(candidate_indices) - 2 - n_attackers
+        masked = distances.masked_fill(~remaining[None, :], float('inf'))
+        scores = torch.sort(masked, dim=1)[0][:, :n_closest].sum(1)
+        scores[~remaining] = float('inf')
+        index = int(torch.argmin(scores))
+
+        candidate_indices.append(index)
+        remaining[index] = False
+        if not multi_k:
+            break
 
-    candidates = []
+    return np.array(candidate_indices, dtype=np.int64)
+
+def weighted_krum_select(distances, weights, n_attackers, multi_k=False):
+    # the score of a row sums its n_closest smallest distances with every row
+    # j counted as often as it has copies left, itself included
+    n = int(weights.sum())
+    remaining = weights.to(distances.device, torch.float64).clone()
     candidate_indices = []
-    remaining_updates = all_updates
-    all_indices = np.arange(len(all_updates))
-
-    while len(remaining_updates) > 2 * n_attackers + 2:
-        torch.cuda.empty_cache()
-        distances = []
-        for update in remaining_updates:
-            distance = []
-            for update_ in remaining_updates:
-                distance.append(torch.norm((update - update_)) ** 2)
-            distance = torch.Tensor(distance).float()
-            distances = distance[None, :] if not len(distances) else torch.cat((distances, distance[None, :]), 0)
-
-        distances = torch.sort(distances, dim=1)[0]
-        scores = torch.sum(distances[:, :len(remaining_updates) - 2 - n_attackers], dim=1)
-        indices = torch.argsort(scores)[:len(remaining_updates) - 2 - n_attackers]
-
-        candidate_indices.append(all_indices[indices[0].cpu().numpy()])
-        all_indices = np.delete(all_indices, indices[0].cpu().numpy())
-        candidates = remaining_updates[indices[0]][None, :] if not len(candidates) else torch.cat((candidates, remaining_updates[indices[0]][None, :]), 0)
-        remaining_updates = torch.cat((remaining_updates[:indices[0]], remaining_updates[indices[0] + 1:]), 0)
+
+    while n - len(candidate_indices) > 2 * n_attackers + 2:
+        n_closest = n - len(candidate_indices) - 2 - n_attackers
+        masked = distances.masked_fill(remaining[None, :] == 0, float('inf'))
+        sorted_distances, order = torch.sort(masked, dim=1)
+        copies = remaining[order]
+        end = copies.cumsum(1)
+        taken = (end.clamp(max=n_closest) - (end - copies)).clamp_(min=0)
+        scores = torch.where(taken > 0, sorted_distances * taken, torch.zeros_like(sorted_distances)).sum(1)
+        scores[remaining == 0] = float('inf')
+        index = int(torch.argmin(scores))
+
+        candidate_indices.append(index)
+        remaining[index] -= 1
         if not multi_k:
             break
-    # print(len(remaining_updates))
 
-    aggregate = torch.mean(candidates, dim=0)
+    return np.array(candidate_indices, dtype=np.int64)
+
+def multi_krum(all_updates, n_attackers, multi_k=False, weights=None):
+    """Returns the mean of the (multi-)krum candidates and their row indices.
+
+    With weights, row i stands for weights[i] identical updates; a row can
+    then be among the candidates several times.
+    """
+    candidate_indices = krum_select(pairwise_distances(all_updates), n_attackers, multi_k, weights)
+    aggregate = update_mean(all_updates[torch.from_numpy(candidate_indices).to(all_updates.device)])
 
-    return aggregate, np.array(candidate_indices)
\ No newline at end of file
+    return aggregate, candidate_indices
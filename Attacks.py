@@ -8,32 +8,93 @@ import torch.nn as nn
 import argparse, os, sys, csv, shutil, time, random, operator, pickle, ast, math, copy
 import numpy as np
 
+class TrimmedMeanAttack(object):
+    """tr_mean of the benign updates plus n_attackers copies of a malicious update, for many malicious updates.
+
+    With a = n_attackers copies inserted, the kept benign values of a
+    coordinate only move within its a smallest and a largest benign values.
+    Those are taken once with topk and prefix summed (float64), chunk by chunk
+    along the parameters like tr_mean, so the state is O(a) per coordinate.
+    The aggregate for a malicious update then follows from where its value
+    falls among them (searchsorted), without stacking and sorting the full
+    matrix again. aggregate() and losses() take a whole batch of candidates
+    at once.
+    """
+    def __init__(self, benign_updates, n_attackers, chunk_size=2**18):
+        a, m = n_attackers, len(benign_updates)
+        self.n_attackers = a
+        self.n_benign = m
+        self.chunk_size = chunk_size
+        self.dtype = benign_updates.dtype
+        self.out_dtype = accum_dtype(benign_updates)
+        n_params, device = benign_updates.shape[1], benign_updates.device
+        self.total = torch.empty(n_params, dtype=torch.float64, device=device)
+        a = min(a, m)
+        # [n_params, a] ascending, and the sums of the j smallest / largest of them
+        self.smallest = torch.empty((n_params, a), dtype=self.dtype, device=device)
+        self.largest = torch.empty((n_params, a), dtype=self.dtype, device=device)
+        self.smallest_sums = torch.zeros((n_params, a + 1), dtype=torch.float64, device=device)
+        self.largest_sums = torch.zeros((n_params, a + 1), dtype=torch.float64, device=device)
+        for start in range(0, n_params, chunk_size):
+            end = start + chunk_size
+            chunk = benign_updates[:, start:end]
+            self.total[start:end] = chunk.sum(0, dtype=torch.float64)
+            smallest = chunk.topk(a, 0, largest=False)[0].t()
+            largest = chunk.topk(a, 0)[0].t()
+            self.smallest[start:end] = smallest
+            self.largest[start:end] = largest.flip(1)
+            torch.cumsum(smallest, 1, dtype=torch.float64, out=self.smallest_sums[start:end, 1:])
+            torch.cumsum(largest, 1, dtype=torch.float64, out=self.largest_sums[start:end, 1:])
+
+    def aggregate(self, mal_updates):
+        """Returns tr_mean(cat([mal_update] * n_attackers, benign_updates), n_attackers) for every row of mal_updates."""
+        a, m = self.n_attackers, self.n_benign
+        if not a:
+            return (self.total / m).to(self.out_dtype).expand(len(mal_updates), -1)
+        if m - a <= 0:
+            return torch.full((len(mal_updates), len(self.total)), float('nan'), dtype=self.out_dtype, device=mal_updates.device)
+
+        out = torch.empty((len(mal_updates), len(self.total)), dtype=self.out_dtype, device=mal_updates.device)
+        for start in range(0, len(self.total), self.chunk_size):
+            end = start + self.chunk_size
+            values = mal_updates[:, start:end].to(self.dtype).t().contiguous()
+            # with k benign values below the malicious one, the sorted column is
+            # sorted[:k], a copies of the value, sorted[k:] and [a, m) is kept:
+            # the benign sorted[min(k, a):max(k, m - a)] and the copies in between
+            low = torch.searchsorted(self.smallest[start:end], values)
+            high = m - a + torch.searchsorted(self.largest[start:end], values)
+            trimmed = self.total[start:end, None] - self.smallest_sums[start:end].gather(1, low)
+            trimmed -= self.largest_sums[start:end].gather(1, m - high)
+            trimmed += (low + m - high - a) * values.double()
+            out[:, start:end] = (trimmed / (m - a)).t()
+        return out
+
+    def losses(self, model_re, deviation, lamdas):
+        """||aggregate - model_re|| of the malicious update model_re - lamda * deviation, for every lamda in lamdas."""
+        mal_updates = model_re[None, :] - lamdas.reshape(-1, 1) * deviation[None, :]
+        return torch.norm(self.aggregate(mal_updates) - model_re, dim=1)
+
 def our_attack_trmean(all_updates, n_attackers, dev_type='sign', threshold=5.0, threshold_diff=1e-5):
     
-    model_re = torch.mean(all_updates, 0)
+    model_re = update_mean(all_updates)
     
     if dev_type == 'sign':
         deviation = torch.sign(model_re)
     elif dev_type == 'unit_vec':
         deviation = model_re / torch.norm(model_re)  # unit vector, dir opp to good dir
     elif dev_type == 'std':
-        deviation = torch.std(all_updates, 0)
+        deviation = update_std(all_updates)
 
-    lamda = torch.Tensor([threshold]).cuda()  # compute_lambda_our(all_updates, model_re, n_attackers)
+    lamda = torch.tensor([threshold], device=all_updates.device)  # compute_lambda_our(all_updates, model_re, n_attackers)
 
     threshold_diff = threshold_diff
     prev_loss = -1
     lamda_fail = lamda
     lamda_succ = 0
+    engine = TrimmedMeanAttack(all_updates, n_attackers)
 
     while torch.abs(lamda_succ - lamda) > threshold_diff:
-        mal_update = (model_re - lamda * deviation)
-        mal_updates = torch.stack([mal_update] * n_attackers)
-        mal_updates = torch.cat((mal_updates, all_updates), 0)
-
-        agg_grads = tr_mean(mal_updates, n_attackers)
-
-        loss = torch.norm(agg_grads - model_re)
+        loss = engine.losses(model_re, deviation, lamda)[0]
 
         if prev_loss < loss:
             # print('successful lamda is ', lamda)
@@ -51,6 +112,58 @@ def our_attack_trmean(all_updates, n_attackers, dev_type='sign', threshold=5.0,
 
 
 
+class KrumAttack(object):
+    """Pairwise distances of n_attackers copies of model_re - lamda * deviation and the benign updates, for any lamda.
+
+    The benign Gram matrix and the inner products of the benign updates with
+    model_re and deviation are computed once (float64, centred on the benign
+    mean like pairwise_distances). The distances of a malicious row to the
+    benign rows are quadratic in lamda, so every candidate lamda only costs
+    O(n^2) scalar work.
+    """
+    def __init__(self, benign_updates, model_re, deviation, n_attackers, chunk_size=2**18):
+        self.n_attackers = n_attackers
+        n = len(benign_updates)
+        device = benign_updates.device
+        center = update_mean(benign_updates).double()
+        gram = torch.zeros((n, n), dtype=torch.float64, device=device)
+        b_dev = torch.zeros(n, dtype=torch.float64, device=device)
+        b_re = torch.zeros(n, dtype=torch.float64, device=device)
+        self.re_re = self.re_dev = self.dev_dev = 0.0
+        for start in range(0, benign_updates.shape[1], chunk_size):
+            chunk = benign_updates[:, start:start + chunk_size].double() - center[start:start + chunk_size]
+            re = model_re[start:start + chunk_size].double() - center[start:start + chunk_size]
+            dev = deviation[start:start + chunk_size].double()
+            gram += chunk @ chunk.t()
+            b_dev += chunk @ dev
+            b_re += chunk @ re
+            self.re_re += float(re @ re)
+            self.re_dev += float(re @ dev)
+            self.dev_dev += float(dev @ dev)
+
+        sq_norms = torch.diagonal(gram)
+        self.benign_distances = (sq_norms[:, None] + sq_norms[None, :] - 2 * gram).clamp_(min=0)
+        self.benign_distances.fill_diagonal_(0)
+        self.sq_norms, self.b_dev, self.b_re = sq_norms, b_dev, b_re
+
+    def distances(self, lamda):
+        """The distance matrix multi_krum would see for the rows [mal_update] * n_attackers + benign_updates."""
+        lamda = float(lamda)
+        a, n = self.n_attackers, len(self.sq_norms)
+        # ||(re - lamda * dev) - b||^2 for every benign b
+        mal_benign = (self.re_re - 2 * lamda * self.re_dev + lamda ** 2 * self.dev_dev
+                      - 2 * (self.b_re - lamda * self.b_dev) + self.sq_norms).clamp_(min=0)
+        distances = torch.zeros((a + n, a + n), dtype=torch.float64, device=mal_benign.device)
+        distances[a:, a:] = self.benign_distances
+        distances[:a, a:] = mal_benign
+        distances[a:, :a] = mal_benign[:, None]
+        return distances
+
+    def succeeds(self, lamda):
+        """Whether multi-krum picks all n_attackers malicious rows for this lamda."""
+        krum_candidate = krum_select(self.distances(lamda), self.n_attackers, multi_k=True)
+        return np.sum(krum_candidate < self.n_attackers) == self.n_attackers
+
 def our_attack_mkrum(all_updates, model_re, n_attackers,dev_type='unit_vec', threshold=5.0, threshold_diff=1e-5):
 
     if dev_type == 'unit_vec':
@@ -58,22 +171,18 @@ def our_attack_mkrum(all_updates, model_re, n_attackers,dev_type='unit_vec', thr
     elif dev_type == 'sign':
         deviation = torch.sign(model_re)
     elif dev_type == 'std':
-        deviation = torch.std(all_updates, 0)
+        deviation = update_std(all_updates)
         
-    lamda = torch.Tensor([threshold]).cuda() #compute_lambda_our(all_updates, model_re, n_attackers)
+    lamda = torch.tensor([threshold], device=all_updates.device) #compute_lambda_our(all_updates, model_re, n_attackers)
     # print(lamda)
     # threshold_diff = 1e-7
     lamda_fail = lamda
     lamda_succ = 0
 
-    while torch.abs(lamda_succ - lamda) > threshold_diff:
-        mal_update = (model_re - lamda * deviation)
-        mal_updates = torch.stack([mal_update] * n_attackers)
-        mal_updates = torch.cat((mal_updates, all_updates), 0)
-
-        agg_grads, krum_candidate = multi_krum(mal_updates, n_attackers, multi_k=True)
+    engine = KrumAttack(all_updates, model_re, deviation, n_attackers)
 
-        if np.sum(krum_candidate < n_attackers) == n_attackers:
+    while torch.abs(lamda_succ - lamda) > threshold_diff:
+        if engine.succeeds(lamda):
             # print('successful lamda is ', lamda)
             lamda_succ = lamda
             lamda = lamda + lamda_fail / 2
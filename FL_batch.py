@@ -0,0 +1,78 @@
+from args import args
+import torch
+import torch.optim as optim
+from torch.optim.lr_scheduler import CosineAnnealingLR
+from collections import defaultdict
+
+try:
+    from torch.func import functional_call, vmap
+except ImportError:  # torch < 2.0, e.g. the 1.13 of requirements.txt
+    try:
+        from functorch import vmap
+        from torch.nn.utils.stateless import functional_call
+    except ImportError:
+        functional_call = vmap = None
+
+
+def score_modules(model):
+    return {str(n): m for n, m in model.named_modules() if hasattr(m, "scores")}
+
+
+def train_clients_batched(FLmodel, loaders, criterion, lr, device):
+    """Trains the scores of several FRL clients at once.
+
+    The scores of every MaskConv layer are stacked over the clients and a single
+    vmapped forward/backward pass is run over the clients' mini-batches. Every
+    client keeps its own leaf tensors, SGD optimizer and cosine schedule, so the
+    result is the same as training a deepcopy of FLmodel per client.
+    Returns one {layer name: trained scores} dict per loader.
+    """
+    if vmap is None:
+        raise RuntimeError("--batched_clients needs torch.func (torch >= 2.0) or functorch (torch 1.13)")
+
+    modules = score_modules(FLmodel)
+    client_scores = [{n: m.scores.detach().clone().requires_grad_(True) for n, m in modules.items()} for _ in loaders]
+    optimizers = [optim.SGD(list(s.values()), lr=lr, momentum=args.momentum, weight_decay=args.wd) for s in client_scores]
+    schedulers = [CosineAnnealingLR(o, T_max=args.local_epochs) for o in optimizers]
+
+    def client_loss(scores, inputs, targets):
+        outputs = functional_call(FLmodel, {n + ".scores": s for n, s in scores.items()}, (inputs,))
+        if len(outputs.shape) == 1:
+            outputs = outputs.unsqueeze(0)
+        return criterion(outputs, targets)
+
+    batched_loss = vmap(client_loss)
+
+    FLmodel.train()
+    for epoch in range(args.local_epochs):
+        iters = [iter(loader) for loader in loaders]
+        active = list(range(len(loaders)))
+        while active:
+            # clients can only be stacked when their batches have the same shape
+            groups = defaultdict(list)
+            for c in active:
+                try:
+                    inputs, targets = next(iters[c])
+                except StopIteration:
+                    continue
+                groups[tuple(inputs.shape)].append((c, inputs, targets))
+
+            active = []
+            for group in groups.values():
+                clients = [c for c, _, _ in group]
+                inputs = torch.stack([x for _, x, _ in group]).to(device, torch.float)
+                targets = torch.stack([y for _, _, y in group]).to(device, torch.long)
+                scores = {n: torch.stack([client_scores[c][n] for c in clients]) for n in modules}
+
+                for c in clients:
+                    optimizers[c].zero_grad()
+                batched_loss(scores, inputs, targets).sum().backward()
+                for c in clients:
+                    optimizers[c].step()
+                active.extend(clients)
+            active.sort()
+
+        for scheduler in schedulers:
+            scheduler.step()
+
+    return [{n: s.detach() for n, s in scores.items()} for scores in client_scores]
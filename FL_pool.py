@@ -0,0 +1,69 @@
+from args import args
+from utils import Find_rank, train
+from updates import ParamLayout
+from replicas import ReplicaPool
+import torch
+import torch.multiprocessing as torch_mp
+import copy
+
+_worker = {}
+
+
+def _init_worker(shared_model, tr_loaders, criterion):
+    # every worker trains one client at a time on a single core
+    torch.set_num_threads(1)
+    _worker['model'] = shared_model
+    _worker['tr_loaders'] = tr_loaders
+    _worker['criterion'] = criterion
+    _worker['layout'] = ParamLayout(shared_model)
+    _worker['replicas'] = ReplicaPool(shared_model)
+
+
+def _run_client(job):
+    kk, e, kind = job
+    # a per (seed, round, client) stream, otherwise every forked worker replays the same batches
+    torch.manual_seed(hash((args.seed, e, int(kk))) & 0xffffffff)
+
+    global_model = _worker['model']
+    mp, optimizer, scheduler = _worker['replicas'].acquire(global_model, args.lr*(args.lrdc**e))
+    for epoch in range(args.local_epochs):
+        train(_worker['tr_loaders'][kk], mp, _worker['criterion'], optimizer, torch.device("cpu"), metrics=False)
+        scheduler.step()
+
+    if kind == "rank":
+        return {str(n): Find_rank(m.scores) for n, m in mp.named_modules() if hasattr(m, "scores")}
+    layout = _worker['layout']
+    return layout.flatten(mp).sub_(layout.flatten(global_model))
+
+
+class ClientPool(object):
+    """Trains the clients of a round on a pool of CPU worker processes.
+
+    The global model lives in shared memory: broadcast() copies the new global
+    state into it in place once per round and the forked workers read it from
+    there instead of receiving a pickled copy with every client.
+    """
+    def __init__(self, FLmodel, tr_loaders, criterion, n_workers):
+        if torch.device(args.device).type != "cpu":
+            raise ValueError("--n_workers is only supported on CPU")
+        self.shared_model = copy.deepcopy(FLmodel).share_memory()
+        ctx = torch_mp.get_context("fork")
+        self.pool = ctx.Pool(n_workers, initializer=_init_worker, initargs=(self.shared_model, tr_loaders, criterion))
+
+    def broadcast(self, FLmodel):
+        with torch.no_grad():
+            shared = self.shared_model.state_dict(keep_vars=True)
+            for name, param in FLmodel.state_dict().items():
+                shared[name].copy_(param)
+
+    def ranks(self, clients, e):
+        """Returns the {layer name: rank} upload of every client in clients."""
+        return self.pool.map(_run_client, [(kk, e, "rank") for kk in clients])
+
+    def updates(self, clients, e):
+        """Returns the flat model update of every client in clients."""
+        return self.pool.map(_run_client, [(kk, e, "update") for kk in clients])
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
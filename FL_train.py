@@ -6,13 +6,17 @@ from utils import *
 
 from AGRs import *
 from Attacks import *
-
-import copy
+from FL_batch import train_clients_batched
+from FL_pool import ClientPool
+from updates import ParamLayout, UpdateBuffer
+from rank_codec import RankCodec
+from checkpoint import Checkpointer
+from metrics import MetricsLog
+from profiler import RoundProfiler
+from replicas import ReplicaPool
+
+import time
 import numpy as np
-import torch.optim as optim
-from torch.optim.lr_scheduler import CosineAnnealingLR
-from collections import defaultdict
-import collections
 
 
 #####################################FRL#########################################
@@ -30,92 +34,176 @@ def FRL_train(tr_loaders, te_loader):
         f.write("\n"+str(sss))
     
     criterion = nn.CrossEntropyLoss().to(args.device)
+    evaluator = EvalSchedule(te_loader)
     FLmodel = getattr(models, args.model)().to(args.device)
+    pool = ClientPool(FLmodel, tr_loaders, criterion, args.n_workers) if args.n_workers else None
+    replicas = ReplicaPool(FLmodel)
     
     initial_scores={}
     for n, m in FLmodel.named_modules():
         if hasattr(m, "scores"):
             initial_scores[str(n)]=m.scores.detach().clone().flatten().sort()[0]
     
+    user_updates = VoteAccumulator(FLmodel, args.round_nclients)
+    # the votes of the attacker's own proxy clients, only trained with partial knowledge
+    sum_args_sorts_mal = VoteAccumulator(FLmodel, args.rand_mal_clients) if args.attacker_knowledge == "partial" else None
+    codec = RankCodec(args.rank_codec)
+    
     e=0
     t_best_acc=0
+    checkpointer = Checkpointer(args.run_base_dir, args.ckpt_every)
+    metrics = MetricsLog(args.run_base_dir, args.metrics_flush_every)
+    profiler = RoundProfiler(args.run_base_dir, args.device, args.profile_sync, args.trace_rounds)
+    state = checkpointer.restore(FLmodel) if args.resume else None
+    if state is not None:
+        e, t_best_acc = state['e'], state['t_best_acc']
+        initial_scores = {n: s.to(args.device) for n, s in state['extra']['initial_scores'].items()}
     while e <= args.FL_global_epochs:
         torch.cuda.empty_cache() 
-        round_users = np.random.choice(args.nClients, args.round_nclients, replace=False)
-        round_malicious = round_users[round_users < n_attackers]
-        round_benign = round_users[round_users >= n_attackers]
-        while len(round_malicious)>=args.round_nclients/2:
+        round_start = time.time()
+        profiler.start_round()
+        with profiler.phase("sampling"):
             round_users = np.random.choice(args.nClients, args.round_nclients, replace=False)
             round_malicious = round_users[round_users < n_attackers]
             round_benign = round_users[round_users >= n_attackers]
+            while len(round_malicious)>=args.round_nclients/2:
+                round_users = np.random.choice(args.nClients, args.round_nclients, replace=False)
+                round_malicious = round_users[round_users < n_attackers]
+                round_benign = round_users[round_users >= n_attackers]
             
-        user_updates=collections.defaultdict(list)
+        user_updates.reset()
+        codec.set_reference(FLmodel)
+        upload_bytes = 0
         ########################################benign Client Learning#########################################
-        for kk in round_benign:
-            mp = copy.deepcopy(FLmodel)
-            optimizer = optim.SGD([p for p in mp.parameters() if p.requires_grad], lr=args.lr*(args.lrdc**e), momentum=args.momentum, weight_decay=args.wd)
-            
-            scheduler = CosineAnnealingLR(optimizer, T_max=args.local_epochs)
-            for epoch in range(args.local_epochs):
-                train_loss, train_acc = train(tr_loaders[kk], mp, criterion, optimizer, args.device)
-                scheduler.step()
-
-            for n, m in mp.named_modules():
-                    if hasattr(m, "scores"):
-                        rank=Find_rank(m.scores.detach().clone())
-                        user_updates[str(n)]=rank[None,:] if len(user_updates[str(n)]) == 0 else torch.cat((user_updates[str(n)], rank[None,:]), 0)
-                        del rank
-            del optimizer, mp, scheduler
+        with profiler.phase("benign"):
+            if pool is not None:
+                pool.broadcast(FLmodel)
+            for client_ranks in local_ranks(FLmodel, tr_loaders, round_benign, criterion, e, pool, replicas):
+                for n, rank in client_ranks.items():
+                    rank, nbytes = codec.transmit(n, rank)
+                    upload_bytes += nbytes
+                    user_updates.add(n, rank)
+                del client_ranks
         ########################################malicious Client Learning######################################
-        if len(round_malicious):
-            sum_args_sorts_mal={}
-            for kk in np.random.choice(n_attackers, min(n_attackers, args.rand_mal_clients), replace=False):
-                torch.cuda.empty_cache()  
-                mp = copy.deepcopy(FLmodel)
-                optimizer = optim.SGD([p for p in mp.parameters() if p.requires_grad], lr=args.lr*(args.lrdc**e), momentum=args.momentum, weight_decay=args.wd)
-                scheduler = CosineAnnealingLR(optimizer, T_max=args.local_epochs)
-                for epoch in range(args.local_epochs):
-                    train_loss, train_acc = train(tr_loaders[kk], mp, criterion, optimizer, args.device)
-                    scheduler.step()
-
-                for n, m in mp.named_modules():
+        with profiler.phase("malicious"):
+            if len(round_malicious):
+                if args.attacker_knowledge == "partial":
+                    sum_args_sorts_mal.reset()
+                    rand_mal = np.random.choice(n_attackers, min(n_attackers, args.rand_mal_clients), replace=False)
+                    for client_ranks in local_ranks(FLmodel, tr_loaders, rand_mal, criterion, e, pool, replicas):
+                        for n, rank in client_ranks.items():
+                            sum_args_sorts_mal.add(n, rank)
+                        del client_ranks
+                    known_votes = sum_args_sorts_mal
+                else:
+                    # omniscient attacker: it sees the benign votes of this round, a layer's
+                    # sums are read before the malicious rows of that layer are added
+                    known_votes = user_updates
+
+                for n, m in FLmodel.named_modules():
                     if hasattr(m, "scores"):
-                        rank=Find_rank(m.scores.detach().clone())
-                        rank_arg=torch.sort(rank)[1]
-                        if str(n) in sum_args_sorts_mal:
-                            sum_args_sorts_mal[str(n)]+=rank_arg
-                        else:
-                            sum_args_sorts_mal[str(n)]=rank_arg
-                        del rank, rank_arg
-                del optimizer, mp, scheduler
-
-            for n, m in FLmodel.named_modules():
-                if hasattr(m, "scores"):
-                    if args.attack_type == "torch_sort":
-                        rank_mal_agr = torch.sort(sum_args_sorts_mal[str(n)], descending=True)[1]
-                    elif args.attack_type == "circular_rotation":
-                        rank_mal_agr = circular_rotation(sum_args_sorts_mal[str(n)])
-                    elif args.attack_type == "reverse_firsthalf_rotation":
-                        rank_mal_agr = reverse_firsthalf_rotation(sum_args_sorts_mal[str(n)])
-                    elif args.attack_type == "reverse_first_secondhalf_rotation":
-                        rank_mal_agr = reverser_middle_firsthalf_rotation(sum_args_sorts_mal[str(n)])
-                    for kk in round_malicious:
-                        user_updates[str(n)]=rank_mal_agr[None,:] if len(user_updates[str(n)]) == 0 else torch.cat((user_updates[str(n)], rank_mal_agr[None,:]), 0)
-            del sum_args_sorts_mal
+                        if args.attack_type == "torch_sort":
+                            rank_mal_agr = torch.sort(known_votes.sums[str(n)], descending=True)[1]
+                        elif args.attack_type == "circular_rotation":
+                            rank_mal_agr = circular_rotation(known_votes.sums[str(n)])
+                        elif args.attack_type == "reverse_firsthalf_rotation":
+                            rank_mal_agr = reverse_firsthalf_rotation(known_votes.sums[str(n)])
+                        elif args.attack_type == "reverse_first_secondhalf_rotation":
+                            rank_mal_agr = reverser_middle_firsthalf_rotation(known_votes.sums[str(n)])
+                        # the rotations return reordered vote sums, the clients upload the ranking they vote for
+                        rank_mal_agr, nbytes = codec.transmit(str(n), vote_rank(rank_mal_agr))
+                        upload_bytes += nbytes * len(round_malicious)
+                        user_updates.add(str(n), rank_mal_agr, weight=len(round_malicious))
         ########################################Server AGR#########################################
-        FRL_Vote(FLmodel, user_updates, initial_scores)
-        del user_updates
-        if (e+1)%1==0:
-            t_loss, t_acc = test(te_loader, FLmodel, criterion, args.device) 
-            if t_acc>t_best_acc:
-                t_best_acc=t_acc
-
-            sss='e %d | malicious users: %d | test acc %.4f test loss %.6f best test_acc %.4f' % (e, len(round_malicious), t_acc, t_loss, t_best_acc)
-            print (sss)
-            with (args.run_base_dir / "output.txt").open("a") as f:
-                f.write("\n"+str(sss))
+        with profiler.phase("aggregation"):
+            FRL_Vote(FLmodel, user_updates, initial_scores)
+        metrics.log(epoch=e, n_malicious=len(round_malicious), upload_bytes=upload_bytes // len(round_users))
+        with profiler.phase("test"):
+            eval_loader, eval_full = evaluator.loader(e)
+            if eval_loader is not None:
+                t_loss, t_acc = test(eval_loader, FLmodel, criterion, args.device)
+                metrics.update(test_acc=t_acc, test_loss=t_loss, eval_full=eval_full)
+                if eval_full and t_acc>t_best_acc:
+                    t_best_acc=t_acc
+
+                sss='e %d | malicious users: %d | test acc %.4f test loss %.6f best test_acc %.4f | upload %d B/client' % (e, len(round_malicious), t_acc, t_loss, t_best_acc, upload_bytes // len(round_users))
+                print (sss)
+                with (args.run_base_dir / "output.txt").open("a") as f:
+                    f.write("\n"+str(sss))
+        metrics.update(round_time=time.time() - round_start, **profiler.end_round(e))
+        if checkpointer.save(e, FLmodel, t_best_acc, initial_scores=initial_scores):
+            metrics.flush()
         e+=1
-        
+    checkpointer.close()
+    metrics.close()
+    if profiler.n_rounds:
+        sss = 'mean time per round: ' + profiler.summary()
+        print (sss)
+        with (args.run_base_dir / "output.txt").open("a") as f:
+            f.write("\n"+str(sss))
+    if pool is not None:
+        pool.close()
+
+def local_ranks(FLmodel, tr_loaders, clients, criterion, e, pool=None, replicas=None):
+    """Yields the {layer name: rank} upload of every client in clients."""
+    if pool is not None:
+        yield from pool.ranks(clients, e)
+        return
+
+    lr = args.lr*(args.lrdc**e)
+    if args.batched_clients:
+        for start in range(0, len(clients), args.batched_clients):
+            chunk = clients[start:start + args.batched_clients]
+            for client_scores in train_clients_batched(FLmodel, [tr_loaders[kk] for kk in chunk], criterion, lr, args.device):
+                yield {n: Find_rank(scores) for n, scores in client_scores.items()}
+        return
+
+    if replicas is None:
+        replicas = ReplicaPool(FLmodel)
+    for kk in clients:
+        mp, optimizer, scheduler = replicas.acquire(FLmodel, lr)
+        for epoch in range(args.local_epochs):
+            train(tr_loaders[kk], mp, criterion, optimizer, args.device, metrics=False)
+            scheduler.step()
+
+        yield {str(n): Find_rank(m.scores.detach().clone()) for n, m in mp.named_modules() if hasattr(m, "scores")}
+
+def local_updates(FLmodel, tr_loaders, clients, criterion, e, layout, model_received, buffer, pool=None, replicas=None):
+    """Writes the flat model update of every client in clients into the next rows of buffer."""
+    if pool is not None:
+        for update in pool.updates(clients, e):
+            buffer.add(update)
+        return
+
+    if replicas is None:
+        replicas = ReplicaPool(FLmodel)
+    for kk in clients:
+        mp, optimizer, scheduler = replicas.acquire(FLmodel, args.lr*(args.lrdc**e))
+        for epoch in range(args.local_epochs):
+            train(tr_loaders[kk], mp, criterion, optimizer, args.device, metrics=False)
+            scheduler.step()
+
+        if buffer.data.dtype == model_received.dtype:
+            update = layout.flatten(mp, out=buffer.next_row())
+            update.sub_(model_received)
+        else:
+            # take the difference in full precision before it is stored
+            buffer.add(layout.flatten(mp).sub_(model_received))
+
+def attacker_updates(FLmodel, tr_loaders, n_attackers, criterion, e, layout, model_received, user_updates, mal_updates, pool=None, replicas=None):
+    """The updates the attacker crafts its malicious update from.
+
+    With --attacker_knowledge partial it trains up to rand_mal_clients of the
+    malicious clients as proxies of the benign ones (into mal_updates),
+    otherwise it knows the benign updates of the round in user_updates.
+    """
+    if args.attacker_knowledge == "full":
+        return user_updates.updates
+    mal_updates.reset()
+    rand_mal = np.random.choice(n_attackers, min(n_attackers, args.rand_mal_clients), replace=False)
+    local_updates(FLmodel, tr_loaders, rand_mal, criterion, e, layout, model_received, mal_updates, pool, replicas)
+    return mal_updates.updates
+
 def circular_rotation(rank):
     middle = len(rank)//2
     return torch.cat((rank[middle:], rank[:middle]))
@@ -148,83 +236,91 @@ def FedAVG(tr_loaders, te_loader):
         f.write("\n"+str(sss))
     
     criterion = nn.CrossEntropyLoss().to(args.device)
+    evaluator = EvalSchedule(te_loader)
     FLmodel = getattr(models, args.model)().to(args.device)
+    pool = ClientPool(FLmodel, tr_loaders, criterion, args.n_workers) if args.n_workers else None
+    replicas = ReplicaPool(FLmodel)
     
-    model_received = []
-    for i, (name, param) in enumerate(FLmodel.state_dict().items()):
-        model_received = param.view(-1).data.type(torch.cuda.FloatTensor) if len(model_received) == 0 else torch.cat((model_received, param.view(-1).data.type(torch.cuda.FloatTensor)))
+    layout = ParamLayout(FLmodel)
+    model_received = layout.bind(FLmodel)
+    update_dtype = getattr(torch, args.update_dtype)
+    user_updates = UpdateBuffer(args.round_nclients, layout.numel, dtype=update_dtype, device=args.device)
+    update_bytes = layout.numel * user_updates.data.element_size()
     
     e=0
     t_best_acc=0
+    checkpointer = Checkpointer(args.run_base_dir, args.ckpt_every)
+    metrics = MetricsLog(args.run_base_dir, args.metrics_flush_every)
+    profiler = RoundProfiler(args.run_base_dir, args.device, args.profile_sync, args.trace_rounds)
+    state = checkpointer.restore(FLmodel) if args.resume else None
+    if state is not None:
+        e, t_best_acc = state['e'], state['t_best_acc']
     while e <= args.FL_global_epochs:
         torch.cuda.empty_cache() 
-        round_users = np.random.choice(args.nClients, args.round_nclients, replace=False)
-        round_malicious = round_users[round_users < n_attackers]
-        round_benign = round_users[round_users >= n_attackers]
-        while len(round_malicious)>=args.round_nclients/2:
+        round_start = time.time()
+        profiler.start_round()
+        with profiler.phase("sampling"):
             round_users = np.random.choice(args.nClients, args.round_nclients, replace=False)
             round_malicious = round_users[round_users < n_attackers]
             round_benign = round_users[round_users >= n_attackers]
+            while len(round_malicious)>=args.round_nclients/2:
+                round_users = np.random.choice(args.nClients, args.round_nclients, replace=False)
+                round_malicious = round_users[round_users < n_attackers]
+                round_benign = round_users[round_users >= n_attackers]
             
-        user_updates = []
+        user_updates.reset()
         ########################################benign Client Learning#########################################
-        for kk in round_benign:
-            mp = copy.deepcopy(FLmodel)
-            optimizer = optim.SGD([p for p in mp.parameters() if p.requires_grad], lr=args.lr*(args.lrdc**e), momentum=args.momentum, weight_decay=args.wd)
-            
-            scheduler = CosineAnnealingLR(optimizer, T_max=args.local_epochs)
-            for epoch in range(args.local_epochs):
-                train_loss, train_acc = train(tr_loaders[kk], mp, criterion, optimizer, args.device)
-                scheduler.step()
-                
-                
-            params = []
-            for i, (name, param) in enumerate(mp.state_dict().items()):
-                params = param.view(-1).data.type(torch.cuda.FloatTensor) if len(params) == 0 else torch.cat((params, param.view(-1).data.type(torch.cuda.FloatTensor)))
-
-            update =  (params - model_received)
-
-            user_updates = update[None,:] if len(user_updates) == 0 else torch.cat((user_updates, update[None,:]), 0)
-
-            del optimizer, mp, scheduler
+        with profiler.phase("benign"):
+            if pool is not None:
+                pool.broadcast(FLmodel)
+            local_updates(FLmodel, tr_loaders, round_benign, criterion, e, layout, model_received, user_updates, pool, replicas)
         ########################################malicious Client Learning######################################
-        for kk in round_malicious:
-            scale=100000
-            mal_update = scale * model_received
-            user_updates = mal_update[None,:] if len(user_updates) == 0 else torch.cat((user_updates, mal_update[None,:]), 0)
+        with profiler.phase("malicious"):
+            if len(round_malicious):
+                scale=100000
+                mal_update = scale * model_received
+                # one row standing for all malicious clients
+                user_updates.add(mal_update, weight=len(round_malicious))
 
         ########################################Server AGR#########################################
-        agg_update = torch.mean(user_updates, dim=0)
-        del user_updates
-        model_received = model_received + agg_update
-        FLmodel = getattr(models, args.model)().to(args.device)
-        start_idx=0
-        state_dict = {}
-        previous_name = 'none'
-        for i, (name, param) in enumerate(FLmodel.state_dict().items()):
-            start_idx = 0 if i == 0 else start_idx + len(FLmodel.state_dict()[previous_name].data.view(-1))
-            start_end = start_idx + len(FLmodel.state_dict()[name].data.view(-1))
-            params = model_received[start_idx:start_end].reshape(FLmodel.state_dict()[name].data.shape)
-            state_dict[name] = params
-            previous_name = name
-
-        FLmodel.load_state_dict(state_dict)
+        with profiler.phase("aggregation"):
+            agg_update = update_mean(user_updates.updates, user_updates.row_weights)
+            model_received.add_(agg_update)
         
-        if (e+1)%1==0:
-            t_loss, t_acc = test(te_loader, FLmodel, criterion, args.device) 
+        metrics.log(epoch=e, n_malicious=len(round_malicious), upload_bytes=update_bytes)
+        try:
+            with profiler.phase("test"):
+                eval_loader, eval_full = evaluator.loader(e)
+                if eval_loader is not None:
+                    t_loss, t_acc = test(eval_loader, FLmodel, criterion, args.device)
+                    metrics.update(test_acc=t_acc, test_loss=t_loss, eval_full=eval_full)
             
-            if t_acc>t_best_acc:
-                t_best_acc=t_acc
+                    if eval_full and t_acc>t_best_acc:
+                        t_best_acc=t_acc
 
-            sss='e %d | malicious users: %d | test acc %.4f test loss %.6f best test_acc %.4f' % (e, len(round_malicious), t_acc, t_loss, t_best_acc)
-            print (sss)
-            with (args.run_base_dir / "output.txt").open("a") as f:
-                f.write("\n"+str(sss))
+                    sss='e %d | malicious users: %d | test acc %.4f test loss %.6f best test_acc %.4f' % (e, len(round_malicious), t_acc, t_loss, t_best_acc)
+                    print (sss)
+                    with (args.run_base_dir / "output.txt").open("a") as f:
+                        f.write("\n"+str(sss))
                 
-            if math.isnan(t_loss) or t_loss > 10000:
-                print('val loss %f... exit: The global model is totally destroyed by the adversary' % t_loss)
-                break
+                    if math.isnan(t_loss) or t_loss > 10000:
+                        print('val loss %f... exit: The global model is totally destroyed by the adversary' % t_loss)
+                        break
+        finally:
+            # also when the model diverged and the loop breaks
+            metrics.update(round_time=time.time() - round_start, **profiler.end_round(e))
+        if checkpointer.save(e, FLmodel, t_best_acc):
+            metrics.flush()
         e+=1
+    checkpointer.close()
+    metrics.close()
+    if profiler.n_rounds:
+        sss = 'mean time per round: ' + profiler.summary()
+        print (sss)
+        with (args.run_base_dir / "output.txt").open("a") as f:
+            f.write("\n"+str(sss))
+    if pool is not None:
+        pool.close()
         
 #######################################Trimmed-Mean######################################
 def Tr_Mean(tr_loaders, te_loader):
@@ -240,103 +336,90 @@ def Tr_Mean(tr_loaders, te_loader):
         f.write("\n"+str(sss))
     
     criterion = nn.CrossEntropyLoss().to(args.device)
+    evaluator = EvalSchedule(te_loader)
     FLmodel = getattr(models, args.model)().to(args.device)
+    pool = ClientPool(FLmodel, tr_loaders, criterion, args.n_workers) if args.n_workers else None
+    replicas = ReplicaPool(FLmodel)
     
-    model_received = []
-    for i, (name, param) in enumerate(FLmodel.state_dict().items()):
-        model_received = param.view(-1).data.type(torch.cuda.FloatTensor) if len(model_received) == 0 else torch.cat((model_received, param.view(-1).data.type(torch.cuda.FloatTensor)))
+    layout = ParamLayout(FLmodel)
+    model_received = layout.bind(FLmodel)
+    update_dtype = getattr(torch, args.update_dtype)
+    user_updates = UpdateBuffer(args.round_nclients, layout.numel, dtype=update_dtype, device=args.device)
+    # the updates of the attacker's own proxy clients, only trained with partial knowledge
+    mal_updates = UpdateBuffer(args.rand_mal_clients, layout.numel, dtype=update_dtype, device=args.device) if args.attacker_knowledge == "partial" else None
+    update_bytes = layout.numel * user_updates.data.element_size()
     
     e=0
     t_best_acc=0
+    checkpointer = Checkpointer(args.run_base_dir, args.ckpt_every)
+    metrics = MetricsLog(args.run_base_dir, args.metrics_flush_every)
+    profiler = RoundProfiler(args.run_base_dir, args.device, args.profile_sync, args.trace_rounds)
+    state = checkpointer.restore(FLmodel) if args.resume else None
+    if state is not None:
+        e, t_best_acc = state['e'], state['t_best_acc']
     while e <= args.FL_global_epochs:
         torch.cuda.empty_cache() 
-        round_users = np.random.choice(args.nClients, args.round_nclients, replace=False)
-        round_malicious = round_users[round_users < n_attackers]
-        round_benign = round_users[round_users >= n_attackers]
-        while len(round_malicious)>=args.round_nclients/2:
+        round_start = time.time()
+        profiler.start_round()
+        with profiler.phase("sampling"):
             round_users = np.random.choice(args.nClients, args.round_nclients, replace=False)
             round_malicious = round_users[round_users < n_attackers]
             round_benign = round_users[round_users >= n_attackers]
+            while len(round_malicious)>=args.round_nclients/2:
+                round_users = np.random.choice(args.nClients, args.round_nclients, replace=False)
+                round_malicious = round_users[round_users < n_attackers]
+                round_benign = round_users[round_users >= n_attackers]
             
-        user_updates = []
+        user_updates.reset()
         ########################################benign Client Learning#########################################
-        for kk in round_benign:
-            mp = copy.deepcopy(FLmodel)
-            optimizer = optim.SGD([p for p in mp.parameters() if p.requires_grad], lr=args.lr*(args.lrdc**e), momentum=args.momentum, weight_decay=args.wd)
-            
-            scheduler = CosineAnnealingLR(optimizer, T_max=args.local_epochs)
-            for epoch in range(args.local_epochs):
-                train_loss, train_acc = train(tr_loaders[kk], mp, criterion, optimizer, args.device)
-                scheduler.step()
-                
-                
-            params = []
-            for i, (name, param) in enumerate(mp.state_dict().items()):
-                params = param.view(-1).data.type(torch.cuda.FloatTensor) if len(params) == 0 else torch.cat((params, param.view(-1).data.type(torch.cuda.FloatTensor)))
-
-            update =  (params - model_received)
-
-            user_updates = update[None,:] if len(user_updates) == 0 else torch.cat((user_updates, update[None,:]), 0)
-
-            del optimizer, mp, scheduler
+        with profiler.phase("benign"):
+            if pool is not None:
+                pool.broadcast(FLmodel)
+            local_updates(FLmodel, tr_loaders, round_benign, criterion, e, layout, model_received, user_updates, pool, replicas)
         ########################################malicious Client Learning######################################
-        if len(round_malicious):
-            mal_updates = []
-            for kk in np.random.choice(n_attackers, min(n_attackers, args.rand_mal_clients), replace=False):
-                mp = copy.deepcopy(FLmodel)
-                optimizer = optim.SGD([p for p in mp.parameters() if p.requires_grad], lr=args.lr*(args.lrdc**e), momentum=args.momentum, weight_decay=args.wd)
-
-                scheduler = CosineAnnealingLR(optimizer, T_max=args.local_epochs)
-                for epoch in range(args.local_epochs):
-                    train_loss, train_acc = train(tr_loaders[kk], mp, criterion, optimizer, args.device)
-                    scheduler.step()
+        with profiler.phase("malicious"):
+            if len(round_malicious):
+                known_updates = attacker_updates(FLmodel, tr_loaders, n_attackers, criterion, e, layout, model_received, user_updates, mal_updates, pool, replicas)
+                mal_update = our_attack_trmean(known_updates, len(round_malicious), dev_type='std', threshold=5.0)
 
-
-                params = []
-                for i, (name, param) in enumerate(mp.state_dict().items()):
-                    params = param.view(-1).data.type(torch.cuda.FloatTensor) if len(params) == 0 else torch.cat((params, param.view(-1).data.type(torch.cuda.FloatTensor)))
-
-                update =  (params - model_received)
-
-                mal_updates = update[None,:] if len(mal_updates) == 0 else torch.cat((mal_updates, update[None,:]), 0)
-
-                del optimizer, mp, scheduler
-                
-            mal_update = our_attack_trmean(mal_updates, len(round_malicious), dev_type='std', threshold=5.0)
-            del mal_updates
-
-            for kk in round_malicious:
-                user_updates = mal_update[None,:] if len(user_updates) == 0 else torch.cat((user_updates, mal_update[None,:]), 0)
+                user_updates.add(mal_update, weight=len(round_malicious))
         ########################################Server AGR#########################################
-        agg_update = tr_mean(user_updates, len(round_malicious))
-        del user_updates
-        model_received = model_received + agg_update
-        FLmodel = getattr(models, args.model)().to(args.device)
-        start_idx=0
-        state_dict = {}
-        previous_name = 'none'
-        for i, (name, param) in enumerate(FLmodel.state_dict().items()):
-            start_idx = 0 if i == 0 else start_idx + len(FLmodel.state_dict()[previous_name].data.view(-1))
-            start_end = start_idx + len(FLmodel.state_dict()[name].data.view(-1))
-            params = model_received[start_idx:start_end].reshape(FLmodel.state_dict()[name].data.shape)
-            state_dict[name] = params
-            previous_name = name
-
-        FLmodel.load_state_dict(state_dict)
+        with profiler.phase("aggregation"):
+            agg_update = tr_mean(user_updates.updates, len(round_malicious), weights=user_updates.row_weights)
+            model_received.add_(agg_update)
         
-        if (e+1)%1==0:
-            t_loss, t_acc = test(te_loader, FLmodel, criterion, args.device) 
-            if math.isnan(t_loss) or t_loss > 10000:
-                print('val loss %f... exit: The global model is totally destroyed by the adversary' % val_loss)
-                break
-            if t_acc>t_best_acc:
-                t_best_acc=t_acc
-
-            sss='e %d | malicious users: %d | test acc %.4f test loss %.6f best test_acc %.4f' % (e, len(round_malicious), t_acc, t_loss, t_best_acc)
-            print (sss)
-            with (args.run_base_dir / "output.txt").open("a") as f:
-                f.write("\n"+str(sss))
+        metrics.log(epoch=e, n_malicious=len(round_malicious), upload_bytes=update_bytes)
+        try:
+            with profiler.phase("test"):
+                eval_loader, eval_full = evaluator.loader(e)
+                if eval_loader is not None:
+                    t_loss, t_acc = test(eval_loader, FLmodel, criterion, args.device)
+                    metrics.update(test_acc=t_acc, test_loss=t_loss, eval_full=eval_full)
+                    if math.isnan(t_loss) or t_loss > 10000:
+                        print('val loss %f... exit: The global model is totally destroyed by the adversary' % t_loss)
+                        break
+                    if eval_full and t_acc>t_best_acc:
+                        t_best_acc=t_acc
+
+                    sss='e %d | malicious users: %d | test acc %.4f test loss %.6f best test_acc %.4f' % (e, len(round_malicious), t_acc, t_loss, t_best_acc)
+                    print (sss)
+                    with (args.run_base_dir / "output.txt").open("a") as f:
+                        f.write("\n"+str(sss))
+        finally:
+            # also when the model diverged and the loop breaks
+            metrics.update(round_time=time.time() - round_start, **profiler.end_round(e))
+        if checkpointer.save(e, FLmodel, t_best_acc):
+            metrics.flush()
         e+=1
+    checkpointer.close()
+    metrics.close()
+    if profiler.n_rounds:
+        sss = 'mean time per round: ' + profiler.summary()
+        print (sss)
+        with (args.run_base_dir / "output.txt").open("a") as f:
+            f.write("\n"+str(sss))
+    if pool is not None:
+        pool.close()
         
         
         
@@ -354,101 +437,88 @@ def Mkrum(tr_loaders, te_loader):
         f.write("\n"+str(sss))
     
     criterion = nn.CrossEntropyLoss().to(args.device)
+    evaluator = EvalSchedule(te_loader)
     FLmodel = getattr(models, args.model)().to(args.device)
+    pool = ClientPool(FLmodel, tr_loaders, criterion, args.n_workers) if args.n_workers else None
+    replicas = ReplicaPool(FLmodel)
     
-    model_received = []
-    for i, (name, param) in enumerate(FLmodel.state_dict().items()):
-        model_received = param.view(-1).data.type(torch.cuda.FloatTensor) if len(model_received) == 0 else torch.cat((model_received, param.view(-1).data.type(torch.cuda.FloatTensor)))
+    layout = ParamLayout(FLmodel)
+    model_received = layout.bind(FLmodel)
+    update_dtype = getattr(torch, args.update_dtype)
+    user_updates = UpdateBuffer(args.round_nclients, layout.numel, dtype=update_dtype, device=args.device)
+    # the updates of the attacker's own proxy clients, only trained with partial knowledge
+    mal_updates = UpdateBuffer(args.rand_mal_clients, layout.numel, dtype=update_dtype, device=args.device) if args.attacker_knowledge == "partial" else None
+    update_bytes = layout.numel * user_updates.data.element_size()
     
     e=0
     t_best_acc=0
+    checkpointer = Checkpointer(args.run_base_dir, args.ckpt_every)
+    metrics = MetricsLog(args.run_base_dir, args.metrics_flush_every)
+    profiler = RoundProfiler(args.run_base_dir, args.device, args.profile_sync, args.trace_rounds)
+    state = checkpointer.restore(FLmodel) if args.resume else None
+    if state is not None:
+        e, t_best_acc = state['e'], state['t_best_acc']
     while e <= args.FL_global_epochs:
         torch.cuda.empty_cache() 
-        round_users = np.random.choice(args.nClients, args.round_nclients, replace=False)
-        round_malicious = round_users[round_users < n_attackers]
-        round_benign = round_users[round_users >= n_attackers]
-        while len(round_malicious)>=args.round_nclients/2:
+        round_start = time.time()
+        profiler.start_round()
+        with profiler.phase("sampling"):
             round_users = np.random.choice(args.nClients, args.round_nclients, replace=False)
             round_malicious = round_users[round_users < n_attackers]
             round_benign = round_users[round_users >= n_attackers]
+            while len(round_malicious)>=args.round_nclients/2:
+                round_users = np.random.choice(args.nClients, args.round_nclients, replace=False)
+                round_malicious = round_users[round_users < n_attackers]
+                round_benign = round_users[round_users >= n_attackers]
             
-        user_updates = []
+        user_updates.reset()
         ########################################benign Client Learning#########################################
-        for kk in round_benign:
-            mp = copy.deepcopy(FLmodel)
-            optimizer = optim.SGD([p for p in mp.parameters() if p.requires_grad], lr=args.lr*(args.lrdc**e), momentum=args.momentum, weight_decay=args.wd)
-            
-            scheduler = CosineAnnealingLR(optimizer, T_max=args.local_epochs)
-            for epoch in range(args.local_epochs):
-                train_loss, train_acc = train(tr_loaders[kk], mp, criterion, optimizer, args.device)
-                scheduler.step()
-                
-                
-            params = []
-            for i, (name, param) in enumerate(mp.state_dict().items()):
-                params = param.view(-1).data.type(torch.cuda.FloatTensor) if len(params) == 0 else torch.cat((params, param.view(-1).data.type(torch.cuda.FloatTensor)))
-
-            update =  (params - model_received)
-
-            user_updates = update[None,:] if len(user_updates) == 0 else torch.cat((user_updates, update[None,:]), 0)
-
-            del optimizer, mp, scheduler
+        with profiler.phase("benign"):
+            if pool is not None:
+                pool.broadcast(FLmodel)
+            local_updates(FLmodel, tr_loaders, round_benign, criterion, e, layout, model_received, user_updates, pool, replicas)
         ########################################malicious Client Learning######################################
-        if len(round_malicious):
-            mal_updates = []
-            for kk in np.random.choice(n_attackers, min(n_attackers, args.rand_mal_clients), replace=False):
-                mp = copy.deepcopy(FLmodel)
-                optimizer = optim.SGD([p for p in mp.parameters() if p.requires_grad], lr=args.lr*(args.lrdc**e), momentum=args.momentum, weight_decay=args.wd)
-
-                scheduler = CosineAnnealingLR(optimizer, T_max=args.local_epochs)
-                for epoch in range(args.local_epochs):
-                    train_loss, train_acc = train(tr_loaders[kk], mp, criterion, optimizer, args.device)
-                    scheduler.step()
-
-
-                params = []
-                for i, (name, param) in enumerate(mp.state_dict().items()):
-                    params = param.view(-1).data.type(torch.cuda.FloatTensor) if len(params) == 0 else torch.cat((params, param.view(-1).data.type(torch.cuda.FloatTensor)))
-
-                update =  (params - model_received)
+        with profiler.phase("malicious"):
+            if len(round_malicious):
+                known_updates = attacker_updates(FLmodel, tr_loaders, n_attackers, criterion, e, layout, model_received, user_updates, mal_updates, pool, replicas)
+                mal_agg_update = update_mean(known_updates)
+                mal_update = our_attack_mkrum(known_updates, mal_agg_update, len(round_malicious), dev_type='std', threshold=5.0, threshold_diff=1e-5)
 
-                mal_updates = update[None,:] if len(mal_updates) == 0 else torch.cat((mal_updates, update[None,:]), 0)
-
-                del optimizer, mp, scheduler
-                
-            mal_agg_update = torch.mean(mal_updates, 0)
-            mal_update = our_attack_mkrum(mal_updates, mal_agg_update, len(round_malicious), dev_type='std', threshold=5.0, threshold_diff=1e-5)
-            del mal_updates
-
-            for kk in round_malicious:
-                user_updates = mal_update[None,:] if len(user_updates) == 0 else torch.cat((user_updates, mal_update[None,:]), 0)
+                user_updates.add(mal_update, weight=len(round_malicious))
         ########################################Server AGR#########################################
-        agg_update, krum_candidate = multi_krum(user_updates, len(round_malicious), multi_k=True)
-        del user_updates
-        model_received = model_received + agg_update
-        FLmodel = getattr(models, args.model)().to(args.device)
-        start_idx=0
-        state_dict = {}
-        previous_name = 'none'
-        for i, (name, param) in enumerate(FLmodel.state_dict().items()):
-            start_idx = 0 if i == 0 else start_idx + len(FLmodel.state_dict()[previous_name].data.view(-1))
-            start_end = start_idx + len(FLmodel.state_dict()[name].data.view(-1))
-            params = model_received[start_idx:start_end].reshape(FLmodel.state_dict()[name].data.shape)
-            state_dict[name] = params
-            previous_name = name
-
-        FLmodel.load_state_dict(state_dict)
+        with profiler.phase("aggregation"):
+            agg_update, krum_candidate = multi_krum(user_updates.updates, len(round_malicious), multi_k=True, weights=user_updates.row_weights)
+            model_received.add_(agg_update)
         
-        if (e+1)%1==0:
-            t_loss, t_acc = test(te_loader, FLmodel, criterion, args.device)
-            if math.isnan(t_loss) or t_loss > 10000:
-                print('val loss %f... exit: The global model is totally destroyed by the adversary' % val_loss)
-                break
-            if t_acc>t_best_acc:
-                t_best_acc=t_acc
-
-            sss='e %d | malicious users: %d | test acc %.4f test loss %.6f best test_acc %.4f' % (e, len(round_malicious), t_acc, t_loss, t_best_acc)
-            print (sss)
-            with (args.run_base_dir / "output.txt").open("a") as f:
-                f.write("\n"+str(sss))
-        e+=1
\ No newline at end of file
+        metrics.log(epoch=e, n_malicious=len(round_malicious), upload_bytes=update_bytes)
+        try:
+            with profiler.phase("test"):
+                eval_loader, eval_full = evaluator.loader(e)
+                if eval_loader is not None:
+                    t_loss, t_acc = test(eval_loader, FLmodel, criterion, args.device)
+                    metrics.update(test_acc=t_acc, test_loss=t_loss, eval_full=eval_full)
+                    if math.isnan(t_loss) or t_loss > 10000:
+                        print('val loss %f... exit: The global model is totally destroyed by the adversary' % t_loss)
+                        break
+                    if eval_full and t_acc>t_best_acc:
+                        t_best_acc=t_acc
+
+                    sss='e %d | malicious users: %d | test acc %.4f test loss %.6f best test_acc %.4f' % (e, len(round_malicious), t_acc, t_loss, t_best_acc)
+                    print (sss)
+                    with (args.run_base_dir / "output.txt").open("a") as f:
+                        f.write("\n"+str(sss))
+        finally:
+            # also when the model diverged and the loop breaks
+            metrics.update(round_time=time.time() - round_start, **profiler.end_round(e))
+        if checkpointer.save(e, FLmodel, t_best_acc):
+            metrics.flush()
+        e+=1
+    checkpointer.close()
+    metrics.close()
+    if profiler.n_rounds:
+        sss = 'mean time per round: ' + profiler.summary()
+        print (sss)
+        with (args.run_base_dir / "output.txt").open("a") as f:
+            f.write("\n"+str(sss))
+    if pool is not None:
+        pool.close()
\ No newline at end of file
@@ -7,7 +7,7 @@ import sys
 args = None
 
 
-def parse_arguments():
+def get_parser():
     # Training settings
     parser = argparse.ArgumentParser(description="FRL")
     
@@ -58,6 +58,39 @@ def parse_arguments():
         "--data_loc", type=str, default="/scratch/hamid/CIFAR10/", help="Location to store data",
     )
     
+    parser.add_argument(
+        "--partition_dir", type=str, default="partitions", help="Directory that caches the client data partitions",
+    )
+    parser.add_argument(
+        "--loader_cache", type=int, default=0, help="Number of recently used client loaders to keep (default: 0, build on every use)",
+    )
+    parser.add_argument(
+        "--in_memory_data",
+        action="store_true",
+        help="Decode the whole dataset into a tensor on the training device and augment whole batches there",
+    )
+    parser.add_argument(
+        "--eval_every", type=int, default=1, help="Test the global model every k rounds (default: 1)"
+    )
+    parser.add_argument(
+        "--eval_subset",
+        type=int,
+        default=0,
+        help="Test on a fixed stratified subset of this many test samples (default: 0, the full test set)",
+    )
+    parser.add_argument(
+        "--eval_full_every",
+        type=int,
+        default=0,
+        help="With --eval_subset, test on the full test set every k rounds (default: 0, only in the last round)",
+    )
+    parser.add_argument(
+        "--eval_batch_size",
+        type=int,
+        default=0,
+        help="Batch size for testing the global model (default: 0, use test_batch_size). The BN layers use batch statistics, so this can change the reported accuracy",
+    )
+    
     parser.add_argument(
         "--conv_type", type=str, default="MaskConv", help="Type of conv layer (defualt: MaskConv)"
     )
@@ -131,12 +164,79 @@ def parse_arguments():
     parser.add_argument(
         "--attack_type", 
         type=str, 
-        default="torch_sort", pis
+        default="torch_sort",
         choices=["torch_sort", "circular_rotation", "reverse_firsthalf_rotation", "reverse_first_secondhalf_rotation"],
         help="Type of attack to use: torch_sort, circular_rotation, reverse_first_secondhalf_rotation, or reverse_firsthalf_rotation (default: torch_sort)"
     )
 
-    args = parser.parse_args()
+    parser.add_argument(
+        "--batched_clients",
+        type=int,
+        default=0,
+        help="Number of FRL clients trained together in one vmapped pass (default: 0, train clients one by one)",
+    )
+    parser.add_argument(
+        "--n_workers",
+        type=int,
+        default=0,
+        help="Number of CPU worker processes that train the clients of a round (default: 0, train in the main process)",
+    )
+    parser.add_argument(
+        "--update_dtype",
+        type=str,
+        default="float32",
+        choices=["float32", "bfloat16", "float16"],
+        help="Storage dtype of the client updates of FedAVG/trimmedMean/Mkrum, aggregation still accumulates in float32 (default: float32)",
+    )
+    parser.add_argument(
+        "--rank_codec",
+        type=str,
+        default="none",
+        choices=["none", "packed", "delta"],
+        help="Encoding of the FRL rank uploads: int64 as is, bit packed, or delta to the global ranking + zlib (default: none)",
+    )
+    parser.add_argument(
+        "--ckpt_every",
+        type=int,
+        default=0,
+        help="Checkpoint the global training state to the run directory every this many epochs (default: 0, never)",
+    )
+    parser.add_argument(
+        "--resume",
+        type=str,
+        default=None,
+        help="Run directory to resume from its checkpoint.pt, the run continues in that directory",
+    )
+    parser.add_argument(
+        "--metrics_flush_every",
+        type=int,
+        default=50,
+        help="Number of rounds the metrics log buffers before it writes them to <run dir>/metrics (default: 50)",
+    )
+    parser.add_argument(
+        "--profile_sync",
+        action="store_true",
+        help="Synchronize the GPU at the boundaries of the round phases, so that their timings are exact",
+    )
+    parser.add_argument(
+        "--trace_rounds",
+        type=int,
+        default=0,
+        help="Number of rounds, after the first one, to record with torch.profiler into <run dir>/traces (default: 0)",
+    )
+    parser.add_argument(
+        "--attacker_knowledge",
+        type=str,
+        default="full",
+        choices=["full", "partial"],
+        help="full: the attacker crafts its update from the benign updates of the round; partial: from rand_mal_clients proxy clients it trains itself (default: full)",
+    )
+
+    return parser
+
+
+def parse_arguments():
+    args = get_parser().parse_args()
 
     # Allow for use from notebook without config file
     if args.config is not None:
@@ -1,7 +1,9 @@
+import glob
 import os
 import matplotlib.pyplot as plt
 import numpy as np
 from collections import defaultdict
+from metrics import read_metrics
 
 def parse_log_file(file_path):
     """Parse a log file and return dict[malicious_users] -> [accuracies]"""
@@ -21,23 +23,35 @@ def parse_log_file(file_path):
                     mal_acc_dict[mal_users].append(test_acc)
     return mal_acc_dict
 
-def process_run_group(base_dir, start_idx, end_idx):
-    """Process a group of runs and return combined malicious user accuracy data"""
+def load_run(dir_path):
+    """Return dict[malicious_users] -> [accuracies] of a run, from its metrics log or, for older runs, its output.txt"""
+    metrics = read_metrics(dir_path)
+    if metrics is None:
+        return parse_log_file(os.path.join(dir_path, "output.txt"))
+    mal_acc_dict = defaultdict(list)
+    # full test set evaluations only, not the --eval_subset ones; only consider up to 12 malicious users
+    keep = (metrics['eval_full'] == 1) & (metrics['n_malicious'] <= 12)
+    for mal_users, test_acc in zip(metrics['n_malicious'][keep].tolist(), metrics['test_acc'][keep].tolist()):
+        mal_acc_dict[int(mal_users)].append(test_acc)
+    return mal_acc_dict
+
+def sweep_run_dirs(sweep_dir, attack_type):
+    """Return the run directories of an attack type in the experiment_script.sh sweep, one per seed"""
+    return sorted(glob.glob(os.path.join(sweep_dir, f"attack_type={attack_type}_seed=*", "FRL~try=0")))
+
+def process_run_group(sweep_dir, attack_type):
+    """Process the runs of an attack type (all seeds) and return combined malicious user accuracy data"""
     combined_data = defaultdict(list)
     
-    for i in range(start_idx, end_idx + 1):
-        dir_path = os.path.join(base_dir, f"FRL~try={i}")
-        file_path = os.path.join(dir_path, "output.txt")
-        
-        if os.path.exists(file_path):
-            try:
-                file_data = parse_log_file(file_path)
-                for mal_users, acc_list in file_data.items():
-                    combined_data[mal_users].extend(acc_list)
-            except Exception as e:
-                print(f"Error processing {file_path}: {e}")
+    for dir_path in sweep_run_dirs(sweep_dir, attack_type):
+        try:
+            file_data = load_run(dir_path)
+            for mal_users, acc_list in file_data.items():
+                combined_data[mal_users].extend(acc_list)
+        except Exception as e:
+            print(f"Error processing {dir_path}: {e}")
     
-    print(f"\nRun Group {start_idx}-{end_idx} Statistics:")
+    print(f"\nRun Group {attack_type} Statistics:")
     print(f"Total malicious user counts: {len(combined_data)}")
     print("Details (users → num_accuracy_values):")
     for mal_users in sorted(combined_data.keys()):
@@ -57,8 +71,8 @@ def plot_malicious_users_boxplot(run_groups):
     positions = []
     xtick_labels = []
     
-    for group_idx, (start_idx, end_idx) in enumerate(run_groups):
-        group_data = process_run_group("Logs", start_idx, end_idx)
+    for group_idx, attack_type in enumerate(run_groups):
+        group_data = process_run_group("Sweeps", attack_type)
         
         # Sort by number of malicious users
         sorted_mal_users = sorted(group_data.keys())
@@ -110,5 +124,5 @@ def plot_malicious_users_boxplot(run_groups):
     plt.show()
 
 # Define run groups and plot
-run_groups = [(0, 4), (5, 9), (10, 14), (15, 19)]  # Added new run group
+run_groups = ["torch_sort", "circular_rotation", "reverse_firsthalf_rotation", "reverse_first_secondhalf_rotation"]  # attack types of the experiment_script.sh sweep
 plot_malicious_users_boxplot(run_groups)
\ No newline at end of file
@@ -0,0 +1,92 @@
+import os
+import random
+import threading
+import numpy as np
+import torch
+
+
+def rng_state():
+    state = {'random': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['random'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def _to_cpu(obj):
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, _to_cpu(v)) for k, v in obj.items())
+    return obj
+
+
+class Checkpointer(object):
+    """Saves the state of a global training loop to run_dir/checkpoint.pt every `every` epochs.
+
+    The state is copied to the CPU when save() is called and written by a
+    background thread, so training only waits for the copy. A checkpoint is
+    written under a temporary name and renamed, a crash during the write
+    leaves the previous one intact.
+    """
+    def __init__(self, run_dir, every=0):
+        self.path = os.path.join(str(run_dir), 'checkpoint.pt')
+        self.every = every
+        self._thread = None
+        self._error = None
+
+    def _write(self, state):
+        try:
+            tmp_path = self.path + '.tmp'
+            torch.save(state, tmp_path)
+            os.replace(tmp_path, self.path)
+        except Exception as exc:
+            self._error = exc
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def save(self, e, FLmodel, t_best_acc, **extra):
+        """Checkpoints the state after epoch e, if e is one of the checkpoint epochs; returns whether it did.
+
+        extra holds loop specific state, e.g. the initial_scores of FRL.
+        """
+        if not self.every or (e + 1) % self.every:
+            return False
+        # at most one write in flight
+        self.wait()
+        state = {
+            'e': e + 1,
+            't_best_acc': t_best_acc,
+            'model': _to_cpu(FLmodel.state_dict()),
+            'extra': _to_cpu(extra),
+            'rng': rng_state(),
+        }
+        self._thread = threading.Thread(target=self._write, args=(state,), daemon=True)
+        self._thread.start()
+        return True
+
+    def restore(self, FLmodel):
+        """Loads the last checkpoint into FLmodel and the RNGs and returns it, None if there is none."""
+        if not os.path.exists(self.path):
+            return None
+        state = torch.load(self.path, map_location='cpu', weights_only=False)
+        FLmodel.load_state_dict(state['model'])
+        set_rng_state(state['rng'])
+        print('=> resuming from %s at epoch %d' % (self.path, state['e']))
+        return state
+
+    def close(self):
+        self.wait()
@@ -1,7 +1,9 @@
 from args import args
 import pickle
-from collections import defaultdict
+from collections import OrderedDict
+import hashlib
 import os
+import shutil
 import random
 import numpy as np
 import torch
@@ -10,46 +12,179 @@ def get_train(dataset, indices, batch_size=args.batch_size, shuffle=True):
     train_loader = torch.utils.data.DataLoader(dataset,
                                                batch_size=batch_size,
                                                sampler=torch.utils.data.sampler.SubsetRandomSampler(indices))
-    
+
     return train_loader
 
-def sample_dirichlet_train_data_train(train_dataset, no_participants, alpha=args.non_iid_degree, force=False):
-    file_add = '%s_train_dirichlet_a_%.1f_n%d.pkl'%(args.set, alpha, no_participants)
-    
-    if not os.path.exists(file_add) or force:
-        print('generating participant indices for alpha %.1f' % alpha)
-
-        tr_classes = {}
-
-        for ind, x in enumerate(train_dataset):
-            _, label = x
-            if label in tr_classes:
-                tr_classes[label].append(ind)
-            else:
-                tr_classes[label] = [ind]
-
-        tr_per_participant_list = defaultdict(list)
-        tr_per_participant_list_labels_fr = defaultdict(defaultdict)
-
-        tr_no_classes = len(tr_classes.keys())
-
-        for n in range(tr_no_classes):
-            random.shuffle(tr_classes[n])
-
-            tr_class_size=len(tr_classes[n])
-            d_sample = np.random.dirichlet(np.array(no_participants * [alpha]))
-            tr_sampled_probabilities = tr_class_size * d_sample ##prob of selecting for this class
-            for user in range(no_participants):
-                no_imgs = int(round(tr_sampled_probabilities[user]))
-                sampled_list = tr_classes[n][:min(len(tr_classes[n]), no_imgs)]
-                random.shuffle(sampled_list)
-                tr_per_participant_list_labels_fr[user][n]=len(sampled_list)
-                tr_per_participant_list[user].extend(sampled_list[:])
-                tr_classes[n] = tr_classes[n][min(len(tr_classes[n]), no_imgs):]
-
-        with open(file_add, 'wb') as f:
-            pickle.dump([tr_per_participant_list, tr_per_participant_list_labels_fr], f)
-    else:
-        [tr_per_participant_list, tr_per_participant_list_labels_fr] = pickle.load(open(file_add, 'rb'))
-
-    return tr_per_participant_list, tr_per_participant_list_labels_fr
\ No newline at end of file
+class ClientLoaders(object):
+    """The train loaders of all participants, built only when a participant is selected.
+
+    Indexing works like the list of loaders it replaces; the cache_size most
+    recently used loaders are kept around (LRU).
+    """
+    def __init__(self, dataset, partition, batch_size=args.batch_size, cache_size=0, make_loader=get_train):
+        self.dataset = dataset
+        self.partition = partition
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self.make_loader = make_loader
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self.partition)
+
+    def __getitem__(self, kk):
+        kk = int(kk)
+        if kk in self._cache:
+            self._cache.move_to_end(kk)
+            return self._cache[kk]
+
+        loader = self.make_loader(self.dataset, self.partition[kk], self.batch_size)
+        if self.cache_size:
+            self._cache[kk] = loader
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return loader
+
+def get_labels(dataset):
+    """Returns the labels of dataset as an array without loading any sample.
+
+    Datasets that are neither torchvision style (targets/labels) nor a Subset
+    of one can provide a get_labels() method; only if there is none the
+    dataset is iterated.
+    """
+    if hasattr(dataset, 'get_labels'):
+        return np.asarray(dataset.get_labels())
+    if isinstance(dataset, torch.utils.data.Subset):
+        return get_labels(dataset.dataset)[np.asarray(dataset.indices)]
+    for attr in ('targets', 'labels'):
+        if hasattr(dataset, attr):
+            return np.asarray(getattr(dataset, attr))
+    return np.array([label for _, label in dataset])
+
+def dirichlet_partition(labels, no_participants, alpha, rng):
+    """Splits the sample indices over no_participants with a per-class Dirichlet(alpha) distribution.
+
+    Every class is shuffled and handed out in consecutive slices whose sizes
+    are round(class_size * p_user), until the class runs out. Returns the
+    indices grouped by participant, the offsets of each participant's slice
+    (CSR style) and the [no_participants, no_classes] label counts.
+    """
+    labels = np.asarray(labels)
+    classes = np.unique(labels)
+    by_class = np.argsort(labels, kind='stable')
+    class_bounds = np.searchsorted(labels[by_class], classes, side='right')
+
+    class_counts = np.zeros((no_participants, len(classes)), dtype=np.int64)
+    owners = []
+    sampled = []
+    start = 0
+    for n, end in enumerate(class_bounds):
+        class_indices = by_class[start:end]
+        rng.shuffle(class_indices)
+        start = end
+
+        d_sample = rng.dirichlet(np.full(no_participants, alpha))
+        no_imgs = np.round(len(class_indices) * d_sample).astype(np.int64)
+        taken = np.minimum(np.cumsum(no_imgs), len(class_indices))
+        class_counts[:, n] = np.diff(taken, prepend=0)
+
+        owners.append(np.repeat(np.arange(no_participants), class_counts[:, n]))
+        sampled.append(class_indices[:taken[-1]])
+
+    owners = np.concatenate(owners)
+    order = np.argsort(owners, kind='stable')
+    indices = np.concatenate(sampled)[order]
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(owners, minlength=no_participants))))
+    return indices, offsets, class_counts
+
+class ClientPartition(object):
+    """Participant -> sample indices map stored as CSR arrays under path.
+
+    indices.npy holds all indices grouped by participant and offsets.npy the
+    start of every participant's slice. The arrays are memory mapped on first
+    access, so opening a partition does not read it.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._arrays = {}
+
+    def _array(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+        return self._arrays[name]
+
+    @property
+    def offsets(self):
+        return self._array('offsets')
+
+    @property
+    def class_counts(self):
+        return self._array('class_counts')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, user):
+        return self._array('indices')[self.offsets[user]:self.offsets[user + 1]]
+
+    def items(self):
+        for user in range(len(self)):
+            yield user, self[user]
+
+    @staticmethod
+    def save(path, indices, offsets, class_counts):
+        # write into a temporary directory and move it in place, so a crashed
+        # run never leaves a half written partition behind
+        tmp_path = '%s.tmp%d' % (path, os.getpid())
+        os.makedirs(tmp_path)
+        np.save(os.path.join(tmp_path, 'indices.npy'), np.asarray(indices, dtype=np.int32))
+        np.save(os.path.join(tmp_path, 'offsets.npy'), np.asarray(offsets, dtype=np.int64))
+        np.save(os.path.join(tmp_path, 'class_counts.npy'), np.asarray(class_counts, dtype=np.int32))
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # another run wrote the same partition first
+            shutil.rmtree(tmp_path)
+        return ClientPartition(path)
+
+def partition_path(dataset_name, alpha, no_participants, seed):
+    key = '%s|%r|%d|%r' % (dataset_name, float(alpha), no_participants, seed)
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return os.path.join(args.partition_dir, '%s_dirichlet_%s' % (dataset_name, digest))
+
+def load_legacy_partition(file_add):
+    # partitions pickled by earlier versions as [defaultdict(list), defaultdict(defaultdict)]
+    [tr_per_participant_list, tr_per_participant_list_labels_fr] = pickle.load(open(file_add, 'rb'))
+    users = sorted(tr_per_participant_list.keys())
+    classes = sorted({label for user in users for label in tr_per_participant_list_labels_fr[user]})
+    indices = np.concatenate([np.asarray(tr_per_participant_list[user], dtype=np.int64) for user in users])
+    offsets = np.concatenate(([0], np.cumsum([len(tr_per_participant_list[user]) for user in users])))
+    class_counts = np.array([[tr_per_participant_list_labels_fr[user].get(label, 0) for label in classes] for user in users])
+    return indices, offsets, class_counts
+
+def sample_dirichlet_train_data_train(train_dataset, no_participants, alpha=args.non_iid_degree, force=False, labels=None):
+    """Returns the ClientPartition of train_dataset and its [participant, class] label counts.
+
+    Partitions are cached under args.partition_dir, keyed by dataset, alpha,
+    number of participants and seed.
+    """
+    path = partition_path(args.set, alpha, no_participants, args.seed)
+    legacy_file_add = '%s_train_dirichlet_a_%.1f_n%d.pkl'%(args.set, alpha, no_participants)
+
+    if force and os.path.exists(path):
+        shutil.rmtree(path)
+    if not os.path.exists(path):
+        os.makedirs(args.partition_dir, exist_ok=True)
+        if os.path.exists(legacy_file_add) and not force:
+            # keep using the partition earlier runs were done with
+            print('converting participant indices from %s' % legacy_file_add)
+            indices, offsets, class_counts = load_legacy_partition(legacy_file_add)
+        else:
+            print('generating participant indices for alpha %.1f' % alpha)
+            if labels is None:
+                labels = get_labels(train_dataset)
+            indices, offsets, class_counts = dirichlet_partition(labels, no_participants, alpha, np.random.RandomState(args.seed))
+        ClientPartition.save(path, indices, offsets, class_counts)
+
+    partition = ClientPartition(path)
+    return partition, partition.class_counts
@@ -2,47 +2,66 @@ from args import args
 from torchvision import datasets, transforms
 import torchvision
 from data.Dirichlet_noniid import *
+from data.device_data import DeviceDataset, DeviceLoader
+
+mean, std = [0.491, 0.482, 0.447], [0.247, 0.243, 0.262]
+_datasets = {}
+
+def load_datasets():
+    """The CIFAR10 train and test sets, decoded once per process.
+
+    Runs forked from one process (sweep.py) share them.
+    """
+    if args.data_loc in _datasets:
+        return _datasets[args.data_loc]
+
+    normalize = transforms.Normalize(mean=mean, std=std)
+
+    train_dataset = torchvision.datasets.CIFAR10(
+        root=args.data_loc,
+        train=True,
+        download=True,
+        transform=transforms.Compose(
+            [
+                transforms.RandomCrop(32, padding=4),
+                transforms.RandomHorizontalFlip(),
+                transforms.ToTensor(),
+                normalize,
+            ]
+        ),
+    )
+
+    test_dataset = torchvision.datasets.CIFAR10(
+        root=args.data_loc,
+        train=False,
+        download=True,
+        transform=transforms.Compose([transforms.ToTensor(), normalize]),
+    )
+    _datasets[args.data_loc] = (train_dataset, test_dataset)
+    return train_dataset, test_dataset
 
 class CIFAR10:
     def __init__(self):
         
         args.output_size = 10
         
-        normalize = transforms.Normalize(mean=[0.491, 0.482, 0.447], std=[0.247, 0.243, 0.262])
-
-        train_dataset = torchvision.datasets.CIFAR10(
-            root=args.data_loc,
-            train=True,
-            download=True,
-            transform=transforms.Compose(
-                [
-                    transforms.RandomCrop(32, padding=4),
-                    transforms.RandomHorizontalFlip(),
-                    transforms.ToTensor(),
-                    normalize,
-                ]
-            ),
-        )
-
-        test_dataset = torchvision.datasets.CIFAR10(
-            root=args.data_loc,
-            train=False,
-            download=True,
-            transform=transforms.Compose([transforms.ToTensor(), normalize]),
-        )
+        train_dataset, test_dataset = load_datasets()
+
+        if args.in_memory_data:
+            # same crop/flip/normalize, applied on device to whole batches
+            train_dataset = DeviceDataset.from_torchvision(train_dataset, mean, std, crop_padding=4, flip=True, device=args.device)
+            test_dataset = DeviceDataset.from_torchvision(test_dataset, mean, std, device=args.device)
 
         tr_per_participant_list, tr_diversity = sample_dirichlet_train_data_train(train_dataset, args.nClients, alpha=args.non_iid_degree, force=False)
 
-        self.tr_loaders = []
-        tr_count = 0
-        for pos, indices in tr_per_participant_list.items():
-            if len(indices)==1 or len(indices)==0:
-                print (pos)
-            tr_count += len(indices)
-            batch_size = args.batch_size
-            self.tr_loaders.append(get_train(train_dataset, indices, args.batch_size))
-#         print ("number of total training points:" ,tr_count)
-        self.te_loader= torch.utils.data.DataLoader(test_dataset, batch_size=args.test_batch_size, shuffle=False)
+        for pos in np.flatnonzero(np.diff(tr_per_participant_list.offsets) <= 1):
+            print (pos)
+        make_loader = DeviceLoader if args.in_memory_data else get_train
+        self.tr_loaders = ClientLoaders(train_dataset, tr_per_participant_list, args.batch_size, args.loader_cache, make_loader)
+        if args.in_memory_data:
+            self.te_loader = DeviceLoader(test_dataset, np.arange(len(test_dataset)), args.test_batch_size, shuffle=False)
+        else:
+            self.te_loader= torch.utils.data.DataLoader(test_dataset, batch_size=args.test_batch_size, shuffle=False)
     
 
     def get_tr_loaders(self):
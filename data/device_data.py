@@ -0,0 +1,80 @@
+import math
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+class DeviceDataset(object):
+    """A whole dataset split decoded once into a uint8 tensor on device.
+
+    batch() gathers a batch of samples and applies the random crop / flip
+    augmentation and the normalisation as tensor ops on the whole batch,
+    instead of running the PIL transform pipeline one sample at a time.
+    """
+    def __init__(self, images, targets, mean, std, crop_padding=0, flip=False, device="cpu"):
+        self.device = torch.device(device)
+        self.images = torch.as_tensor(images, dtype=torch.uint8).to(self.device)
+        self.targets = torch.as_tensor(np.asarray(targets), dtype=torch.long).to(self.device)
+        self.mean = torch.tensor(mean, device=self.device).view(1, -1, 1, 1)
+        self.std = torch.tensor(std, device=self.device).view(1, -1, 1, 1)
+        self.crop_padding = crop_padding
+        self.flip = flip
+
+    @classmethod
+    def from_torchvision(cls, dataset, mean, std, **kwargs):
+        images = torch.as_tensor(np.asarray(dataset.data))
+        if images.dim() == 3:
+            # MNIST style [N, H, W]
+            images = images.unsqueeze(1)
+        else:
+            # CIFAR style [N, H, W, C]
+            images = images.permute(0, 3, 1, 2)
+        return cls(images.contiguous(), dataset.targets, mean, std, **kwargs)
+
+    def __len__(self):
+        return len(self.targets)
+
+    def get_labels(self):
+        return self.targets.cpu().numpy()
+
+    def random_crop(self, x):
+        # same as transforms.RandomCrop(size, padding=p) with zero fill, for every sample of x
+        p = self.crop_padding
+        n, c, h, w = x.shape
+        padded = F.pad(x, (p, p, p, p))
+        top = torch.randint(0, 2 * p + 1, (n,), device=x.device)
+        left = torch.randint(0, 2 * p + 1, (n,), device=x.device)
+        rows = (top[:, None] + torch.arange(h, device=x.device))[:, None, :, None]
+        cols = (left[:, None] + torch.arange(w, device=x.device))[:, None, None, :]
+        batch = torch.arange(n, device=x.device)[:, None, None, None]
+        channels = torch.arange(c, device=x.device)[None, :, None, None]
+        return padded[batch, channels, rows, cols]
+
+    def batch(self, indices):
+        x = self.images[indices].float().div_(255)
+        if self.crop_padding:
+            x = self.random_crop(x)
+        if self.flip:
+            flipped = torch.rand(len(x), device=x.device) < 0.5
+            x = torch.where(flipped[:, None, None, None], x.flip(3), x)
+        x = (x - self.mean) / self.std
+        return x, self.targets[indices]
+
+
+class DeviceLoader(object):
+    """Iterates over some samples of a DeviceDataset in (shuffled) batches, like a DataLoader would."""
+    def __init__(self, dataset, indices, batch_size, shuffle=True):
+        self.dataset = dataset
+        self.indices = torch.from_numpy(np.array(indices, dtype=np.int64)).to(dataset.device)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return math.ceil(len(self.indices) / self.batch_size)
+
+    def __iter__(self):
+        indices = self.indices
+        if self.shuffle:
+            indices = indices[torch.randperm(len(indices), device=indices.device)]
+        for start in range(0, len(indices), self.batch_size):
+            yield self.dataset.batch(indices[start:start + self.batch_size])
@@ -2,33 +2,51 @@ from args import args
 from torchvision import datasets, transforms
 import torchvision
 from data.Dirichlet_noniid import *
+from data.device_data import DeviceDataset, DeviceLoader
+
+mean, std = (0.1307,), (0.3081,)
+_datasets = {}
+
+def load_datasets():
+    """The MNIST train and test sets, decoded once per process.
+
+    Runs forked from one process (sweep.py) share them.
+    """
+    if args.data_loc in _datasets:
+        return _datasets[args.data_loc]
+
+    Mytransform = transforms.Compose([
+        transforms.ToTensor(),
+        transforms.Normalize(mean, std),
+    ])
+
+    train_dataset = datasets.MNIST(root=args.data_loc, train=True, download=True, transform=Mytransform)
+
+    test_dataset = datasets.MNIST(root=args.data_loc, train=False, download=True, transform=Mytransform)
+    _datasets[args.data_loc] = (train_dataset, test_dataset)
+    return train_dataset, test_dataset
 
 class MNIST:
     def __init__(self):
         
         args.output_size = 10
         
-        Mytransform = transforms.Compose([
-            transforms.ToTensor(),
-            transforms.Normalize((0.1307,), (0.3081,)),
-        ])
-
-        train_dataset = datasets.MNIST(root=args.data_loc, train=True, download=True, transform=Mytransform)
+        train_dataset, test_dataset = load_datasets()
 
-        test_dataset = datasets.MNIST(root=args.data_loc, train=False, download=True, transform=Mytransform)
+        if args.in_memory_data:
+            train_dataset = DeviceDataset.from_torchvision(train_dataset, mean, std, device=args.device)
+            test_dataset = DeviceDataset.from_torchvision(test_dataset, mean, std, device=args.device)
 
         tr_per_participant_list, tr_diversity = sample_dirichlet_train_data_train(train_dataset, args.nClients, alpha=args.non_iid_degree, force=False)
 
-        self.tr_loaders = []
-        tr_count = 0
-        for pos, indices in tr_per_participant_list.items():
-            if len(indices)==1 or len(indices)==0:
-                print (pos)
-            tr_count += len(indices)
-            batch_size = args.batch_size
-            self.tr_loaders.append(get_train(train_dataset, indices, args.batch_size))
-#         print ("number of total training points:" ,tr_count)
-        self.te_loader= torch.utils.data.DataLoader(test_dataset, batch_size=args.test_batch_size, shuffle=False)
+        for pos in np.flatnonzero(np.diff(tr_per_participant_list.offsets) <= 1):
+            print (pos)
+        make_loader = DeviceLoader if args.in_memory_data else get_train
+        self.tr_loaders = ClientLoaders(train_dataset, tr_per_participant_list, args.batch_size, args.loader_cache, make_loader)
+        if args.in_memory_data:
+            self.te_loader = DeviceLoader(test_dataset, np.arange(len(test_dataset)), args.test_batch_size, shuffle=False)
+        else:
+            self.te_loader= torch.utils.data.DataLoader(test_dataset, batch_size=args.test_batch_size, shuffle=False)
     
 
     def get_tr_loaders(self):
@@ -1,33 +1,9 @@
 #!/bin/bash
 
-RUNS=20
-
-echo "Starting experiment..."
-
-for ((i=1; i<=$RUNS; i++)); do
-    echo "Running experiment $i..."
-    
-    Determine the attack type based on the run number
-    if (( i <= 5 )); then
-        ATTACK_TYPE="torch_sort"
-    elif (( i <= 10 )); then
-        ATTACK_TYPE="circular_rotation"
-    elif (( i <= 15 )); then
-        ATTACK_TYPE="reverse_firsthalf_rotation"
-    else
-        ATTACK_TYPE="reverse_first_secondhalf_rotation"
-    fi
-    
-    # Run the Python script with the specified attack type
-    python main.py --data_loc "./data/MNIST/" --config experiments/006_config_MNIST_LeNet_FRL_1000users_noniid1.0_20pmal.txt --attack_type $ATTACK_TYPE
-    
-    # Check if the Python script completed successfully
-    if [[ $? -ne 0 ]]; then
-        echo "Error: Experiment $i failed. Exiting."
-        exit 1
-    fi
-    
-    echo "Experiment $i completed with attack type: $ATTACK_TYPE"
-done
-
-echo "Experiment completed."
\ No newline at end of file
+# 4 attack types x 5 seeds of the MNIST LeNet FRL experiment with 20% malicious clients,
+# on as many workers as there are cores; finished runs are skipped when started again.
+# graphruns.py and boxplotruns.py plot the runs from Sweeps/, one group per attack type.
+python sweep.py --workers "$(nproc)" \
+    --grid attack_type=torch_sort,circular_rotation,reverse_firsthalf_rotation,reverse_first_secondhalf_rotation \
+    --grid seed=0,1,2,3,4 \
+    -- --data_loc "./data/MNIST/" --config experiments/006_config_MNIST_LeNet_FRL_1000users_noniid1.0_20pmal.txt
@@ -1,7 +1,9 @@
+import glob
 import os
 import matplotlib.pyplot as plt
 from collections import defaultdict
 import numpy as np
+from metrics import read_metrics
 
 def parse_log_file(file_path):
     """Parse a log file and return epoch -> test_acc mapping"""
@@ -16,27 +18,33 @@ def parse_log_file(file_path):
                 epoch_data[epoch] = test_acc
     return epoch_data
 
-def process_run_group(base_dir, start_idx, end_idx, epoch_range=(100, 2000)):
-    """Process a group of runs (e.g., FRL~try=0 to FRL~try=4) and return averaged test accuracies"""
+def load_run(dir_path):
+    """Return epoch -> test_acc of a run, from its metrics log or, for older runs, its output.txt"""
+    metrics = read_metrics(dir_path)
+    if metrics is None:
+        return parse_log_file(os.path.join(dir_path, "output.txt"))
+    # only the evaluations on the full test set, not the --eval_subset ones (NaN in rows without an evaluation)
+    evaluated = metrics['eval_full'] == 1
+    return dict(zip(metrics['epoch'][evaluated].tolist(), metrics['test_acc'][evaluated].tolist()))
+
+def sweep_run_dirs(sweep_dir, attack_type):
+    """Return the run directories of an attack type in the experiment_script.sh sweep, one per seed"""
+    return sorted(glob.glob(os.path.join(sweep_dir, f"attack_type={attack_type}_seed=*", "FRL~try=0")))
+
+def process_run_group(sweep_dir, attack_type, epoch_range=(100, 2000)):
+    """Process the runs of an attack type (all seeds) and return averaged test accuracies"""
     all_epoch_data = []
     
-    for i in range(start_idx, end_idx + 1):
-        dir_path = os.path.join(base_dir, f"FRL~try={i}")
-        file_path = os.path.join(dir_path, "output.txt")
-        
-        if not os.path.exists(file_path):
-            print(f"Warning: {file_path} not found. Skipping.")
-            continue
-        
+    for dir_path in sweep_run_dirs(sweep_dir, attack_type):
         try:
-            epoch_data = parse_log_file(file_path)
+            epoch_data = load_run(dir_path)
             all_epoch_data.append(epoch_data)
-            print(f"Processed {file_path}")
+            print(f"Processed {dir_path}")
         except Exception as e:
-            print(f"Error processing {file_path}: {e}")
+            print(f"Error processing {dir_path}: {e}")
     
     if not all_epoch_data:
-        raise ValueError(f"No valid files in group {start_idx}-{end_idx}")
+        raise ValueError(f"No valid runs of {attack_type} in {sweep_dir}")
     
     # Average test accuracies across files in this group
     avg_data = defaultdict(list)
@@ -64,9 +72,9 @@ def plot_multiple_runs(run_groups, epoch_range=(100, 2000)):
               'Run 3 (Modified Inverted Attack)', 'Run 4 (Modified Circular Rotation)']
     stride = 5  # Plot every 5th point
     
-    for idx, (start_idx, end_idx) in enumerate(run_groups):
+    for idx, attack_type in enumerate(run_groups):
         try:
-            epoch_acc_data = process_run_group("Logs", start_idx, end_idx, epoch_range)
+            epoch_acc_data = process_run_group("Sweeps", attack_type, epoch_range)
             epochs = sorted(epoch_acc_data.keys())
             accuracies = [epoch_acc_data[e] for e in epochs]
             
@@ -78,7 +86,7 @@ def plot_multiple_runs(run_groups, epoch_range=(100, 2000)):
                     alpha=0.8)
             
         except Exception as e:
-            print(f"Error processing group {start_idx}-{end_idx}: {e}")
+            print(f"Error processing group {attack_type}: {e}")
     
     plt.xlabel('Epoch', fontsize=12)
     plt.ylabel('Test Accuracy', fontsize=12)
@@ -93,12 +101,12 @@ def plot_multiple_runs(run_groups, epoch_range=(100, 2000)):
     plt.savefig("accuracy_comparison.png")
     plt.show()
 
-# Define the run groups (start_idx, end_idx)
+# Define the run groups, the attack types of the experiment_script.sh sweep
 run_groups = [
-    (0, 4),    # Run 1: Files 0-4
-    (5, 9),    # Run 2: Files 5-9
-    (10, 14),  # Run 3: Files 10-14
-    (15, 19)   # Run 4: Files 15-19
+    "torch_sort",                         # Run 1
+    "circular_rotation",                  # Run 2
+    "reverse_firsthalf_rotation",         # Run 3
+    "reverse_first_secondhalf_rotation"   # Run 4
 ]
 
 # Generate the plot
@@ -10,31 +10,57 @@ from FL_train import *
 
 
 
-def main():
+def seed_everything():
     if args.seed is not None:
         random.seed(args.seed)
         torch.manual_seed(args.seed)
         torch.cuda.manual_seed(args.seed)
         torch.cuda.manual_seed_all(args.seed)
-        
-        
+
+
+def make_run_dir():
     # Make the a directory corresponding to this run for saving results, checkpoints etc.
-    i = 0
-    while True:
-        run_base_dir = pathlib.Path(f"{args.log_dir}/FRL~try={str(i)}")
+    if args.resume:
+        run_base_dir = pathlib.Path(args.resume)
+        if not run_base_dir.is_dir():
+            raise ValueError(f"--resume: no run directory {run_base_dir}")
+        with (run_base_dir / "output.txt").open("a") as f:
+            f.write("\nresumed with " + str(args))
+    else:
+        i = 0
+        while True:
+            run_base_dir = pathlib.Path(f"{args.log_dir}/FRL~try={str(i)}")
 
-        if not run_base_dir.exists():
-            os.makedirs(run_base_dir)
-            args.name = args.name + f"~try={i}"
-            break
-        i += 1
+            if not run_base_dir.exists():
+                os.makedirs(run_base_dir)
+                args.name = args.name + f"~try={i}"
+                break
+            i += 1
 
-    (run_base_dir / "output.txt").write_text(str(args))
+        (run_base_dir / "output.txt").write_text(str(args))
     args.run_base_dir = run_base_dir
 
     print(f"=> Saving data in {run_base_dir}")
-    
-    
+    return run_base_dir
+
+
+def run_FL(tr_loaders, te_loader):
+    print ("type of FL: ", args.FL_type)
+    if args.FL_type == "FRL":
+        FRL_train(tr_loaders, te_loader)
+    elif args.FL_type == "FedAVG":
+        FedAVG(tr_loaders, te_loader)
+    elif args.FL_type == "trimmedMean":
+        Tr_Mean(tr_loaders, te_loader)
+    elif args.FL_type == "Mkrum":
+        Mkrum(tr_loaders, te_loader)
+    else:
+        FedAVG(tr_loaders, te_loader)
+
+
+def main():
+    seed_everything()
+    make_run_dir()
     
     #distribute the dataset
     print ("dataset to use is: ", args.set)
@@ -43,28 +69,16 @@ def main():
     print ("batch size is : ", args.batch_size)
     print ("test batch size is: ", args.test_batch_size)
     
-    data_distributer = getattr(data, args.set)()
-    tr_loaders = data_distributer.get_tr_loaders()
-    te_loader = data_distributer.get_te_loader()
-    
-    
     args.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     use_cuda = torch.cuda.is_available()
     print ("use_cuda: ", use_cuda)
     
+    data_distributer = getattr(data, args.set)()
+    tr_loaders = data_distributer.get_tr_loaders()
+    te_loader = data_distributer.get_te_loader()
     
     #Federated Learning
-    print ("type of FL: ", args.FL_type)
-    if args.FL_type == "FRL":
-        FRL_train(tr_loaders, te_loader)
-    elif args.FL_type == "FedAVG":
-        FedAVG(tr_loaders, te_loader)
-    elif args.FL_type == "trimmedMean":
-        Tr_Mean(tr_loaders, te_loader)
-    elif args.FL_type == "Mkrum":
-        Mkrum(tr_loaders, te_loader)
-    else:
-        FedAVG(tr_loaders, te_loader)
+    run_FL(tr_loaders, te_loader)
 
    
 if __name__ == "__main__":
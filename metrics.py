@@ -0,0 +1,78 @@
+import glob
+import math
+import os
+import numpy as np
+
+
+class MetricsLog(object):
+    """Append-only columnar log of the per-round metrics of a run.
+
+    log() buffers one row in memory; once flush_every rows are buffered they are
+    written to run_dir/metrics/chunk_NNNNNN.npz, one array per column.
+    Columns can be added at any round, rows without a value get NaN.
+    """
+    def __init__(self, run_dir, flush_every=50):
+        self.dir = os.path.join(str(run_dir), 'metrics')
+        os.makedirs(self.dir, exist_ok=True)
+        self.flush_every = flush_every
+        self.n_chunks = len(glob.glob(os.path.join(self.dir, 'chunk_*.npz')))
+        self.rows = []
+
+    def log(self, **row):
+        # flushed before the new row, so that update() always finds it in the buffer
+        if len(self.rows) >= self.flush_every:
+            self.flush()
+        self.rows.append(row)
+
+    def update(self, **values):
+        """Adds values to the last logged row."""
+        self.rows[-1].update(values)
+
+    def flush(self):
+        if not self.rows:
+            return
+        names = []
+        for row in self.rows:
+            names.extend(name for name in row if name not in names)
+        columns = {name: np.array([row.get(name, math.nan) for row in self.rows]) for name in names}
+
+        path = os.path.join(self.dir, 'chunk_%06d.npz' % self.n_chunks)
+        tmp_path = os.path.join(self.dir, 'tmp_%06d.npz' % self.n_chunks)
+        np.savez(tmp_path, **columns)
+        os.replace(tmp_path, path)
+        self.n_chunks += 1
+        self.rows = []
+
+    def close(self):
+        self.flush()
+
+
+def read_metrics(run_dir):
+    """Returns {column: array} of all rows logged in run_dir, None if it has no metrics log.
+
+    Epochs that were logged more than once (a run resumed from an older
+    checkpoint) keep their last row.
+    """
+    paths = sorted(glob.glob(os.path.join(str(run_dir), 'metrics', 'chunk_*.npz')))
+    if not paths:
+        return None
+    chunks = []
+    for path in paths:
+        with np.load(path) as chunk:
+            chunks.append({name: chunk[name] for name in chunk.files})
+
+    names = []
+    for chunk in chunks:
+        names.extend(name for name in chunk if name not in names)
+    columns = {}
+    for name in names:
+        columns[name] = np.concatenate([chunk[name] if name in chunk else np.full(len(next(iter(chunk.values()))), math.nan)
+                                        for chunk in chunks])
+
+    if 'epoch' in columns:
+        epochs = columns['epoch']
+        # index of the last row of every epoch
+        _, last = np.unique(epochs[::-1], return_index=True)
+        keep = np.sort(len(epochs) - 1 - last)
+        columns = {name: column[keep] for name, column in columns.items()}
+    return columns
@@ -9,6 +9,7 @@ import sys
 import time
 import math
 
+import torch
 import torch.nn as nn
 import torch.nn.init as init
 from torch.autograd import Variable
@@ -59,18 +60,28 @@ def mkdir_p(path):
 class AverageMeter(object):
     """Computes and stores the average and current value
        Imported from https://github.com/pytorch/examples/blob/master/imagenet/main.py#L247-L262
+
+       Values may also be device tensors: they are summed on the device and
+       only read back when avg is read.
     """
     def __init__(self):
         self.reset()
 
     def reset(self):
         self.val = 0
-        self.avg = 0
         self.sum = 0
         self.count = 0
 
     def update(self, val, n=1):
+        if torch.is_tensor(val):
+            val = val.detach()
         self.val = val
         self.sum += val * n
         self.count += n
-        self.avg = self.sum / self.count
\ No newline at end of file
+
+    @property
+    def avg(self):
+        if self.count == 0:
+            return 0
+        avg = self.sum / self.count
+        return avg.item() if torch.is_tensor(avg) else avg
@@ -104,6 +104,21 @@ def get_subnet(scores, k):
 
     return out
 
+def get_subnet_kth(scores, k):
+    # Same top k% mask as GetSubnet, but from a kthvalue threshold instead of a full sort
+    j = int((1 - k) * scores.numel())
+    if j == 0:
+        return torch.ones_like(scores)
+    threshold = scores.flatten().kthvalue(j).values
+    return (scores > threshold).to(scores.dtype)
+
+
+def get_subnet_ste(scores, k):
+    # get_subnet_kth passed straight-through with plain tensor ops, so it also works under vmap
+    out = get_subnet_kth(scores.detach(), k)
+    return out + scores - scores.detach()
+
+
 def get_subnet_signed(scores, k):
     out = scores.clone()
     _, idx = scores.abs().flatten().sort()
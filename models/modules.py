@@ -34,9 +34,31 @@ class MaskConv(nn.Conv2d):
             
         # default sparsity
         self.sparsity = pargs.sparsity
+
+        # mask of the current scores, see subnet()
+        self._subnet = None
+        self._subnet_key = None
+
+    def invalidate_subnet(self):
+        self._subnet = None
+
+    def subnet(self):
+        # the mask only changes with the scores: recompute it when they are
+        # replaced or modified in place (their version counter moves)
+        key = (self.scores, self.scores._version)
+        if self._subnet is None or self._subnet_key[0] is not key[0] or self._subnet_key[1] != key[1]:
+            with torch.no_grad():
+                self._subnet = module_util.get_subnet_kth(self.scores.abs(), self.sparsity)
+            self._subnet_key = key
+        return self._subnet
         
     def forward(self, x):
-        subnet = module_util.GetSubnet.apply(self.scores.abs(), self.sparsity)
+        if self.training:
+            # the scores move every step, so no caching, and a kthvalue
+            # threshold instead of GetSubnet's full sort
+            subnet = module_util.get_subnet_ste(self.scores.abs(), self.sparsity)
+        else:
+            subnet = self.subnet()
         w = self.weight * subnet
         x = F.conv2d(
             x, w, self.bias, self.stride, self.padding, self.dilation, self.groups
@@ -0,0 +1,82 @@
+import contextlib
+import os
+import resource
+import time
+from collections import OrderedDict, defaultdict
+import torch
+
+
+class RoundProfiler(object):
+    """Times the phases of the global rounds of a training loop.
+
+    Every phase of a round is timed with a `with profiler.phase(name):` block;
+    end_round() returns the round's {t_<phase>: seconds} and a memory column,
+    which the loops add to the metrics log of the run: peak_mem, the peak GPU
+    memory of the round, or on CPU peak_rss, the peak RSS of the process so far
+    (the OS keeps no per-round peak).
+
+    sync=True synchronizes the GPU at the phase boundaries, otherwise the time
+    of queued kernels is booked to a later phase. trace_rounds > 0 records the
+    rounds after the first (warm-up) one with torch.profiler and writes them
+    as chrome traces to run_dir/traces.
+    """
+    def __init__(self, run_dir, device, sync=False, trace_rounds=0):
+        self.run_dir = str(run_dir)
+        self.device = torch.device(device)
+        self.cuda = self.device.type == 'cuda'
+        self.sync = sync and self.cuda
+        self.trace_rounds = trace_rounds
+        self.times = OrderedDict()
+        self.totals = defaultdict(float)
+        self.n_rounds = 0
+        self._trace = None
+
+    def _synchronize(self):
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+
+    def start_round(self):
+        self.times = OrderedDict()
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+        if 0 < self.n_rounds <= self.trace_rounds:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._trace = torch.profiler.profile(activities=activities, profile_memory=True)
+            self._trace.__enter__()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        self._synchronize()
+        start = time.perf_counter()
+        with torch.profiler.record_function(name) if self._trace is not None else contextlib.nullcontext():
+            yield
+            self._synchronize()
+        self.times[name] = self.times.get(name, 0.0) + time.perf_counter() - start
+
+    def peak_memory(self):
+        """Peak allocated GPU memory of the round, on CPU the peak RSS over the lifetime of the process (bytes)."""
+        if self.cuda:
+            return torch.cuda.max_memory_allocated(self.device)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def end_round(self, e):
+        if self._trace is not None:
+            self._trace.__exit__(None, None, None)
+            trace_dir = os.path.join(self.run_dir, 'traces')
+            os.makedirs(trace_dir, exist_ok=True)
+            self._trace.export_chrome_trace(os.path.join(trace_dir, 'round_%d.json' % e))
+            self._trace = None
+
+        self.n_rounds += 1
+        stats = OrderedDict()
+        for name, seconds in self.times.items():
+            self.totals[name] += seconds
+            stats['t_' + name] = seconds
+        stats['peak_mem' if self.cuda else 'peak_rss'] = self.peak_memory()
+        return stats
+
+    def summary(self):
+        """Mean time per round of every phase so far."""
+        return ' | '.join('%s %.3fs' % (name, total / self.n_rounds) for name, total in self.totals.items())
@@ -0,0 +1,90 @@
+import math
+import struct
+import zlib
+import numpy as np
+import torch
+
+
+def bit_width(n):
+    """Bits needed to store any value in [0, n)."""
+    return max(1, math.ceil(math.log2(n))) if n > 1 else 1
+
+
+def pack_bits(values, bits):
+    """Packs the non-negative integers in values into bits bits each (big endian)."""
+    values = np.asarray(values, dtype=np.uint64)
+    shifts = np.arange(bits - 1, -1, -1, dtype=np.uint64)
+    return np.packbits(((values[:, None] >> shifts) & 1).astype(np.uint8)).tobytes()
+
+
+def unpack_bits(data, bits, n):
+    bitmat = np.unpackbits(np.frombuffer(data, dtype=np.uint8), count=n * bits).reshape(n, bits)
+    weights = np.left_shift(np.uint64(1), np.arange(bits - 1, -1, -1, dtype=np.uint64))
+    return bitmat.astype(np.uint64) @ weights
+
+
+class RankCodec(object):
+    """Encodes the FRL rank uploads of the clients for transmission.
+
+    none   -- the int64 permutations as they are, 8 bytes per entry
+    packed -- every entry in ceil(log2(n)) bits
+    delta  -- every entry as its (zigzag) offset from its position in the
+              reference ranking, bit packed and zlib compressed
+
+    The reference is the ranking of the current global scores, which the
+    server and every client of the round know; set_reference() takes it from
+    the global model before local training.
+    """
+    MODES = ("none", "packed", "delta")
+
+    def __init__(self, mode="none"):
+        if mode not in self.MODES:
+            raise ValueError("unknown rank codec %r" % mode)
+        self.mode = mode
+        self.reference = {}
+        self._inverse = {}
+
+    def set_reference(self, FLmodel):
+        if self.mode != "delta":
+            return
+        for n, m in FLmodel.named_modules():
+            if hasattr(m, "scores"):
+                ref = m.scores.detach().flatten().sort()[1].cpu().numpy()
+                inverse = np.empty_like(ref)
+                inverse[ref] = np.arange(len(ref))
+                self.reference[str(n)] = ref
+                self._inverse[str(n)] = inverse
+
+    def encode(self, name, rank):
+        rank = rank.detach().cpu().numpy().astype(np.int64)
+        if self.mode == "none":
+            return rank.tobytes()
+        # packed and delta only hold the values of a permutation of range(len(rank))
+        if len(rank) and (rank.min() < 0 or rank.max() >= len(rank)):
+            raise ValueError("%s: rank is no permutation of %d entries" % (name, len(rank)))
+        if self.mode == "packed":
+            return pack_bits(rank, bit_width(len(rank)))
+
+        offsets = self._inverse[name][rank] - np.arange(len(rank))
+        zigzag = np.where(offsets < 0, -2 * offsets - 1, 2 * offsets)
+        bits = max(1, int(zigzag.max()).bit_length())
+        return struct.pack("<B", bits) + zlib.compress(pack_bits(zigzag, bits))
+
+    def decode(self, name, data, n):
+        if self.mode == "none":
+            rank = np.frombuffer(data, dtype=np.int64)
+        elif self.mode == "packed":
+            rank = unpack_bits(data, bit_width(n), n).astype(np.int64)
+        else:
+            bits = struct.unpack("<B", data[:1])[0]
+            zigzag = unpack_bits(zlib.decompress(data[1:]), bits, n).astype(np.int64)
+            offsets = np.where(zigzag & 1, -(zigzag + 1) // 2, zigzag // 2)
+            rank = self.reference[name][offsets + np.arange(n)]
+        return torch.from_numpy(rank.copy())
+
+    def transmit(self, name, rank):
+        """Returns rank as the server receives it and the number of bytes sent."""
+        if self.mode == "none":
+            return rank, rank.numel() * 8
+        data = self.encode(name, rank)
+        return self.decode(name, data, rank.numel()).to(rank.device), len(data)
@@ -0,0 +1,50 @@
+from args import args
+import torch
+import torch.optim as optim
+from torch.optim.lr_scheduler import CosineAnnealingLR
+import copy
+
+
+class ReplicaPool(object):
+    """Client models that are built once and reset from the global model for every client.
+
+    acquire() copies the trainable tensors of the global model (the scores of
+    MaskConv layers, all parameters of StandardConv models) and its buffers
+    into a replica in place. Frozen parameters are not copied at all, the
+    replica points to the global model's tensors, which training never
+    writes. The replica's SGD optimizer is kept as well: its momentum buffers
+    are zeroed, which with dampening 0 is the same as starting without one.
+    """
+    def __init__(self, FLmodel, size=1):
+        self.replicas = []
+        for _ in range(size):
+            model = copy.deepcopy(FLmodel)
+            optimizer = optim.SGD([p for p in model.parameters() if p.requires_grad], lr=args.lr, momentum=args.momentum, weight_decay=args.wd)
+            self.replicas.append((model, optimizer))
+        self.next = 0
+
+    def acquire(self, FLmodel, lr):
+        """Returns a replica reset to FLmodel, its optimizer at lr and a new cosine schedule over the local epochs."""
+        model, optimizer = self.replicas[self.next]
+        self.next = (self.next + 1) % len(self.replicas)
+
+        with torch.no_grad():
+            global_params = dict(FLmodel.named_parameters())
+            for name, param in model.named_parameters():
+                if param.requires_grad:
+                    param.copy_(global_params[name])
+                    param.grad = None
+                else:
+                    param.data = global_params[name].data
+            global_buffers = dict(FLmodel.named_buffers())
+            for name, buf in model.named_buffers():
+                buf.copy_(global_buffers[name])
+
+        for group in optimizer.param_groups:
+            group['lr'] = group['initial_lr'] = lr
+            for param in group['params']:
+                buf = optimizer.state[param].get('momentum_buffer')
+                if buf is not None:
+                    buf.zero_()
+        scheduler = CosineAnnealingLR(optimizer, T_max=args.local_epochs)
+        return model, optimizer, scheduler
@@ -0,0 +1,150 @@
+"""Runs a grid of FL experiments on a pool of worker processes.
+
+    python sweep.py --workers 4 --grid attack_type=torch_sort,circular_rotation --grid seed=0,1,2 \
+        -- --data_loc "./data/MNIST/" --config experiments/006_config_MNIST_LeNet_FRL_1000users_noniid1.0_20pmal.txt
+
+Everything after -- is passed on to main.py, the --grid values override it
+(and the config file). Every configuration runs in its own directory under
+--sweep_dir, which gets a "done" marker once the run finished; those are
+skipped when the sweep is started again. An interrupted run starts again in
+its FRL~try=0 directory, from its checkpoint if it wrote one (--ckpt_every).
+
+The datasets and partitions of the sweep are loaded once in this process
+and the runs are forked from it, so they share them.
+"""
+import argparse
+import importlib
+import itertools
+import os
+import pathlib
+import sys
+import multiprocessing
+from multiprocessing.connection import wait
+
+
+def parse_sweep_arguments():
+    parser = argparse.ArgumentParser(description="FRL sweep")
+    parser.add_argument(
+        "--grid",
+        action="append",
+        default=[],
+        metavar="KEY=V1,V2,...",
+        help="main.py option and the values to sweep over, e.g. FL_type=FRL,FedAVG, at_fractions=0.1,0.2, seed=0,1,2 or non_iid_degree=0.5,1.0 (repeatable)",
+    )
+    parser.add_argument("--workers", type=int, default=1, help="Number of runs at a time (default: 1)")
+    parser.add_argument("--cores_per_worker", type=int, default=1, help="CPU cores every run is pinned to (default: 1)")
+    parser.add_argument("--sweep_dir", type=str, default="Sweeps", help="Directory of the run directories (default: Sweeps)")
+    parser.add_argument("main_args", nargs=argparse.REMAINDER, help="-- followed by the arguments of main.py")
+    sweep_args = parser.parse_args()
+    if sweep_args.main_args[:1] == ["--"]:
+        sweep_args.main_args = sweep_args.main_args[1:]
+    return sweep_args
+
+
+sweep_args = parse_sweep_arguments()
+# main.py reads its options from the command line on import
+sys.argv = [sys.argv[0]] + sweep_args.main_args
+
+import numpy as np
+import torch
+
+from args import args, get_parser
+import data
+from data.Dirichlet_noniid import sample_dirichlet_train_data_train
+import main
+
+
+def parse_grid(grid):
+    """Returns the list of {option: value} configurations of the grid, values typed like main.py's."""
+    parser = get_parser()
+    axes = []
+    for entry in grid:
+        key, values = entry.split("=", 1)
+        axes.append([(key, vars(parser.parse_args(["--" + key, v]))[key]) for v in values.split(",")])
+    return [dict(config) for config in itertools.product(*axes)]
+
+
+def config_name(config):
+    return "_".join("%s=%s" % (key, value) for key, value in config.items()) or "base"
+
+
+def preload(configs):
+    """Decodes the datasets and writes the partitions of all configs before any run is forked."""
+    base = dict(vars(args))
+    for config in configs:
+        args.__dict__.update(config)
+        dataset_module = importlib.import_module(getattr(data, args.set).__module__)
+        train_dataset, _ = dataset_module.load_datasets()
+        sample_dirichlet_train_data_train(train_dataset, args.nClients, alpha=args.non_iid_degree)
+    args.__dict__.update(base)
+
+
+def run_config(config, run_dir, cores):
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    # forked runs would otherwise all continue the numpy stream of the sweep process
+    np.random.seed()
+    sys.stdout = sys.stderr = open(run_dir / "stdout.txt", "a", buffering=1)
+
+    args.__dict__.update(config)
+    args.log_dir = str(run_dir)
+    args.name = "%s_%s" % (args.name, config_name(config))
+    # a configuration has a single run directory: a rerun continues in it, from its
+    # checkpoint if there is one and from scratch otherwise
+    last_run = run_dir / "FRL~try=0"
+    if last_run.exists():
+        args.resume = str(last_run)
+    main.main()
+    (run_dir / "done").touch()
+
+
+def sweep():
+    configs = parse_grid(sweep_args.grid)
+    sweep_dir = pathlib.Path(sweep_args.sweep_dir)
+    pending = []
+    for config in configs:
+        run_dir = sweep_dir / config_name(config)
+        if (run_dir / "done").exists():
+            print("=> skipping finished %s" % run_dir)
+            continue
+        os.makedirs(run_dir, exist_ok=True)
+        pending.append((config, run_dir))
+    print("=> %d of %d configurations to run" % (len(pending), len(configs)))
+    if not pending:
+        return
+
+    preload([config for config, _ in pending])
+
+    cores = sorted(os.sched_getaffinity(0))
+    n_slots = max(1, min(sweep_args.workers, len(cores) // sweep_args.cores_per_worker))
+    slots = [cores[i * sweep_args.cores_per_worker:(i + 1) * sweep_args.cores_per_worker] or cores for i in range(n_slots)]
+    free = list(range(n_slots))
+
+    ctx = multiprocessing.get_context("fork")
+    running = {}
+    failed = []
+    while pending or running:
+        while pending and free:
+            config, run_dir = pending.pop(0)
+            slot = free.pop(0)
+            process = ctx.Process(target=run_config, args=(config, run_dir, slots[slot]))
+            process.start()
+            print("=> started %s on cores %s" % (run_dir, slots[slot]))
+            running[process.sentinel] = (process, slot, run_dir)
+
+        for sentinel in wait(list(running)):
+            process, slot, run_dir = running.pop(sentinel)
+            process.join()
+            free.append(slot)
+            if process.exitcode != 0:
+                failed.append(run_dir)
+                print("=> %s failed (exit code %d), see %s" % (run_dir, process.exitcode, run_dir / "stdout.txt"))
+            else:
+                print("=> finished %s" % run_dir)
+
+    if failed:
+        sys.exit("%d runs failed" % len(failed))
+
+
+if __name__ == "__main__":
+    sweep()
@@ -0,0 +1,80 @@
+import torch
+
+
+class ParamLayout(object):
+    """Fixed flat layout of a model's state_dict entries.
+
+    flatten() writes the entries of any model with the same architecture into
+    one flat vector, bind() makes the entries of a model views into one.
+    """
+    def __init__(self, model):
+        self.names = []
+        self.shapes = []
+        self.offsets = [0]
+        for name, param in model.state_dict().items():
+            self.names.append(name)
+            self.shapes.append(param.shape)
+            self.offsets.append(self.offsets[-1] + param.numel())
+        self.numel = self.offsets[-1]
+
+    def flatten(self, model, out=None, dtype=torch.float):
+        state_dict = model.state_dict()
+        if out is None:
+            out = torch.empty(self.numel, dtype=dtype, device=state_dict[self.names[0]].device)
+        for i, name in enumerate(self.names):
+            out[self.offsets[i]:self.offsets[i + 1]].copy_(state_dict[name].view(-1))
+        return out
+
+    def bind(self, model, flat=None):
+        """Makes every state_dict entry of model a view into one flat tensor and returns it.
+
+        Afterwards an in-place update of the flat tensor updates the model.
+        """
+        state_dict = model.state_dict(keep_vars=True)
+        if flat is None:
+            flat = self.flatten(model)
+        for i, name in enumerate(self.names):
+            state_dict[name].data = flat[self.offsets[i]:self.offsets[i + 1]].view(self.shapes[i])
+        return flat
+
+
+class UpdateBuffer(object):
+    """Preallocated [n_rows, n_cols] matrix that the clients of a round write their updates into.
+
+    It is allocated once and reset() every round; updates is the view of the
+    rows written so far. A row added with weight k stands for k identical
+    updates, e.g. the copies of one malicious update.
+    """
+    def __init__(self, n_rows, n_cols, dtype=torch.float, device=None):
+        self.data = torch.empty((n_rows, n_cols), dtype=dtype, device=device)
+        self.weights = torch.ones(n_rows, dtype=torch.long, device=device)
+        self.count = 0
+        self.weighted = False
+
+    def __len__(self):
+        return self.count
+
+    def reset(self):
+        self.count = 0
+        self.weighted = False
+
+    def next_row(self, weight=1):
+        if self.count == len(self.data):
+            raise IndexError("UpdateBuffer is full (%d rows)" % len(self.data))
+        row = self.data[self.count]
+        self.weights[self.count] = weight
+        self.weighted = self.weighted or weight != 1
+        self.count += 1
+        return row
+
+    def add(self, update, weight=1):
+        self.next_row(weight).copy_(update)
+
+    @property
+    def updates(self):
+        return self.data[:self.count]
+
+    @property
+    def row_weights(self):
+        """The weights of updates, None while every row has weight 1."""
+        return self.weights[:self.count] if self.weighted else None
@@ -1,6 +1,8 @@
 from args import args
 from eval import *
 from misc import *
+from data.Dirichlet_noniid import get_labels
+from data.device_data import DeviceLoader
 import torch
 import pickle
 import torch.nn as nn
@@ -13,25 +15,72 @@ def Find_rank(scores):
     return idx.detach()
 
 
+def vote_rank(row):
+    """Returns the rank permutation whose vote is the one of row, ordered by its values.
+
+    VoteAccumulator.add(name, vote_rank(row)) votes like the rows FRL_Vote
+    sorts, e.g. the rotated vote sums of the malicious clients, which are no
+    permutation themselves.
+    """
+    return torch.sort(torch.sort(row, stable=True)[1])[1]
+
+
+class VoteAccumulator(object):
+    """Running FRL vote of a round, one client at a time.
+
+    For every scored layer it keeps the sum over clients of each score's
+    position in the client's ranking, which is what FRL_Vote sorts. Ranks are
+    scattered into the sum and can be dropped right away, so memory is
+    O(n_params) instead of O(n_clients x n_params).
+    """
+    def __init__(self, FLmodel, n_clients):
+        self.sums = {}
+        self.positions = {}
+        for n, m in FLmodel.named_modules():
+            if hasattr(m, "scores"):
+                numel = m.scores.numel()
+                # int32 holds the sum unless n_clients * numel overflows it
+                dtype = torch.int32 if n_clients * numel < 2**31 else torch.long
+                self.sums[str(n)] = torch.zeros(numel, dtype=dtype, device=m.scores.device)
+                self.positions[str(n)] = torch.arange(numel, dtype=dtype, device=m.scores.device)
+
+    def reset(self):
+        for sums in self.sums.values():
+            sums.zero_()
+
+    def add(self, name, rank, weight=1):
+        """Adds the vote of a rank permutation (as returned by Find_rank), weight times."""
+        # position of score rank[p] is p, i.e. torch.sort(rank)[1] without the sort
+        self.sums[name].index_add_(0, rank, self.positions[name], alpha=weight)
+
+
 def FRL_Vote(FLmodel, user_updates, initial_scores):
     for n, m in FLmodel.named_modules():
         if hasattr(m, "scores"):
-            args_sorts=torch.sort(user_updates[str(n)])[1]
-            sum_args_sorts=torch.sum(args_sorts, 0)
+            if isinstance(user_updates, VoteAccumulator):
+                sum_args_sorts=user_updates.sums[str(n)]
+            else:
+                args_sorts=torch.sort(user_updates[str(n)])[1]
+                sum_args_sorts=torch.sum(args_sorts, 0)
             idxx=torch.sort(sum_args_sorts)[1]
             temp1=m.scores.detach().clone()
             temp1.flatten()[idxx]=initial_scores[str(n)]
             m.scores=torch.nn.Parameter(temp1)                    
+            m.invalidate_subnet()
             del idxx, temp1
             
             
-def train(trainloader, model, criterion, optimizer, device):
+def train(trainloader, model, criterion, optimizer, device, metrics=True):
+    """Runs one epoch of training and returns its mean loss and top-1 accuracy.
+
+    The metrics are accumulated on device and read back once at the end; with
+    metrics=False they are not computed at all and (None, None) is returned.
+    """
     # switch to train mode
     model.train()
 
     losses = AverageMeter()
     top1 = AverageMeter()
-    top5 = AverageMeter()
 
     for batch_ind, (inputs, targets) in enumerate(trainloader):
 
@@ -43,25 +92,29 @@ def train(trainloader, model, criterion, optimizer, device):
             outputs = outputs.unsqueeze(0)
         loss = criterion(outputs, targets)
 
-        # measure accuracy and record loss
-        prec1, prec5 = accuracy(outputs.data, targets.data, topk=(1, 5))
-        losses.update(loss.item(), inputs.size()[0])
-        top1.update(prec1.item()/100.0, inputs.size()[0])
-        top5.update(prec5.item()/100.0, inputs.size()[0])
+        # record loss and accuracy
+        if metrics:
+            losses.update(loss, inputs.size(0))
+            top1.update((outputs.detach().argmax(1) == targets).float().mean(), inputs.size(0))
 
         # compute gradient and do SGD step
         optimizer.zero_grad()
         loss.backward()
         optimizer.step()
-        
+
+    if not metrics:
+        return (None, None)
     return (losses.avg, top1.avg)
 
 
 def test(testloader, model, criterion, device):
+    """Returns the mean loss and top-1 accuracy of model on testloader.
+
+    Both are accumulated on device and read back once at the end.
+    """
     model.eval()
     losses = AverageMeter()
     top1 = AverageMeter()
-    top5 = AverageMeter()
     
     with torch.no_grad():
         for batch_ind, (inputs, targets) in enumerate(testloader):
@@ -71,10 +124,52 @@ def test(testloader, model, criterion, device):
             if len(outputs.shape) == 1:
                 outputs = outputs.unsqueeze(0)
             
-            loss = criterion(outputs, targets)
-            # measure accuracy and record loss
-            prec1, prec5 = accuracy(outputs.data, targets.data, topk=(1, 5))
-            losses.update(loss.data, inputs.size()[0])
-            top1.update(prec1/100.0, inputs.size()[0])
-            top5.update(prec5/100.0, inputs.size()[0])
-    return (losses.avg, top1.avg)
\ No newline at end of file
+            losses.update(criterion(outputs, targets), inputs.size(0))
+            top1.update((outputs.argmax(1) == targets).double().mean(), inputs.size(0))
+    return (losses.avg, top1.avg)
+
+
+def stratified_subset(labels, size, seed):
+    """size indices of labels drawn without replacement, keeping the class proportions."""
+    rng = np.random.RandomState(seed)
+    classes, counts = np.unique(labels, return_counts=True)
+    per_class = np.round(size * counts / counts.sum()).astype(np.int64)
+    subset = [rng.choice(np.flatnonzero(labels == c), min(k, n), replace=False) for c, k, n in zip(classes, per_class, counts)]
+    return np.sort(np.concatenate(subset))
+
+
+class EvalSchedule(object):
+    """Decides in which rounds the global model is tested, and on what.
+
+    Rounds are evaluated every args.eval_every rounds (and always in the last
+    one). With args.eval_subset the evaluation runs on a fixed stratified
+    subset of the test set, with a full pass every args.eval_full_every rounds
+    and in the last round. args.eval_batch_size overrides the test batch size.
+    """
+    def __init__(self, te_loader):
+        batch_size = args.eval_batch_size or args.test_batch_size
+        self.full = self.make_loader(te_loader, None, batch_size) if args.eval_batch_size else te_loader
+        self.subset = None
+        if args.eval_subset:
+            labels = get_labels(te_loader.dataset)
+            indices = stratified_subset(labels, args.eval_subset, args.seed)
+            self.subset = self.make_loader(te_loader, indices, batch_size)
+
+    @staticmethod
+    def make_loader(te_loader, indices, batch_size):
+        if isinstance(te_loader, DeviceLoader):
+            indices = te_loader.indices.cpu().numpy() if indices is None else indices
+            return DeviceLoader(te_loader.dataset, indices, batch_size, shuffle=False)
+        dataset = te_loader.dataset if indices is None else torch.utils.data.Subset(te_loader.dataset, indices)
+        return torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False)
+
+    def loader(self, e):
+        """Returns (test loader, is full test set) for round e, or (None, False) if e is not evaluated."""
+        last = e == args.FL_global_epochs
+        if (e + 1) % args.eval_every and not last:
+            return None, False
+        if self.subset is None:
+            return self.full, True
+        if last or (args.eval_full_every and (e + 1) % args.eval_full_every == 0):
+            return self.full, True
+        return self.subset, False